@@ -0,0 +1,39 @@
+# Atomic replacement of a file which is rewritten as a whole.
+#
+# The data goes to a temporary file that then replaces the file, so it is never
+# left half written.
+import os
+
+
+def write_file_atomic(path, data):
+    """
+    Replace the file with data and fsync it. Returns when it is on disk.
+
+    :param data: bytes
+    """
+    dir_path = os.path.dirname(path)
+    if not os.path.exists(dir_path):
+        os.makedirs(dir_path)
+    temp_path = path + ".tmp"
+    with open(temp_path, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, path)
+    sync_dir(dir_path)
+
+
+def sync_dir(dir_path):
+    """
+    fsync a directory so a rename in it is durable. Not supported on Windows.
+    """
+    try:
+        fd = os.open(dir_path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
@@ -1,33 +1,111 @@
+import threading
 import torch
 import torch.nn.functional as F
-import copy
 import comfy
 from comfy.ldm.modules.attention import optimized_attention
 
-def get_masks_from_q(masks, q, original_shape):
-
-    if original_shape[2] * original_shape[3] == q.shape[1]:
+def get_down_sample_rate(q_tokens, original_shape):
+    if original_shape[2] * original_shape[3] == q_tokens:
         down_sample_rate = 1
-    elif (original_shape[2] // 2) * (original_shape[3] // 2) == q.shape[1]:
+    elif (original_shape[2] // 2) * (original_shape[3] // 2) == q_tokens:
         down_sample_rate = 2
-    elif (original_shape[2] // 4) * (original_shape[3] // 4) == q.shape[1]:
+    elif (original_shape[2] // 4) * (original_shape[3] // 4) == q_tokens:
         down_sample_rate = 4
     else:
         down_sample_rate = 8
+    return down_sample_rate
+
+def get_masks_from_q(masks, q, original_shape):
+    """
+    Downsample region masks to the query tokens.
 
+    Returns a [len(masks), q tokens, 1] tensor which broadcasts over the batch
+    and channels, or None when there is no coupling (a single False mask).
+    """
+    if len(masks) == 1 and not isinstance(masks[0], torch.Tensor): # coupling処理なしの場合
+        return None
+
+    down_sample_rate = get_down_sample_rate(q.shape[1], original_shape)
+    size = (original_shape[2] // down_sample_rate, original_shape[3] // down_sample_rate)
     ret_masks = []
     for mask in masks:
-        if isinstance(mask,torch.Tensor):
-            size = (original_shape[2] // down_sample_rate, original_shape[3] // down_sample_rate)
-            mask_downsample = F.interpolate(mask.unsqueeze(0), size=size, mode="nearest")
-            mask_downsample = mask_downsample.view(1,-1, 1).repeat(q.shape[0], 1, q.shape[2])
-            ret_masks.append(mask_downsample)
-        else: # coupling処理なしの場合
-            ret_masks.append(torch.ones_like(q))
-    
+        mask_downsample = F.interpolate(mask.unsqueeze(0), size=size, mode="nearest")
+        ret_masks.append(mask_downsample.view(1, -1, 1))
     ret_masks = torch.cat(ret_masks, dim=0)
+
+    # Ensure masks match the query tokens
+    if ret_masks.shape[1] > q.shape[1]:
+        ret_masks = ret_masks[:, :q.shape[1], :]
+    elif ret_masks.shape[1] < q.shape[1]:
+        pad_length = q.shape[1] - ret_masks.shape[1]
+        padding = torch.zeros((ret_masks.shape[0], pad_length, 1), dtype=ret_masks.dtype, device=ret_masks.device)
+        ret_masks = torch.cat([ret_masks, padding], dim=1)
     return ret_masks
 
+class MaskAtlas:
+    """
+    Region masks of a layout, [regions, height, width], and their device copies for one attention couple.
+    The normalized masks and their get_masks_from_q() results are cached, so they are built once per
+    patched model instead of once per queue. The masks may be shared with other atlases and
+    conditionings, so neither they nor the cached results may be modified in place.
+    """
+
+    def __init__(self, masks):
+        self.masks = masks
+        self.normalized = {}  # (strengths, device, dtype) -> normalized masks
+        self.downsampled = {}  # (strengths, device, dtype, original_shape, q tokens) -> get_masks_from_q()
+        self.lock = threading.Lock()
+
+    def get_normalized(self, strengths, device, dtype):
+        key = (strengths, device, dtype)
+        with self.lock:
+            if key not in self.normalized:
+                strength = torch.tensor(strengths, device=device, dtype=dtype).view(-1, 1, 1, 1)
+                mask_norm = self.masks.unsqueeze(1).to(device, dtype=dtype) * strength
+                mask_norm = mask_norm / mask_norm.sum(dim=0)
+                self.normalized[key] = [mask_norm[i] for i in range(mask_norm.shape[0])]
+            return self.normalized[key]
+
+    def get_masks_from_q(self, strengths, device, dtype, q, original_shape):
+        key = (strengths, device, dtype, tuple(original_shape), q.shape[1])
+        masks = self.downsampled.get(key)
+        if masks is None:
+            masks = get_masks_from_q(self.get_normalized(strengths, device, dtype), q, original_shape)
+            with self.lock:
+                self.downsampled[key] = masks
+        return masks
+
+def sparse_attention(q, k, v, regions, heads):
+    """
+    Masked sum of the attention of each region, computed only for the query tokens the region covers.
+
+    q is [batch, tokens, channels], k and v are [regions, context tokens, channels]
+    and regions are get_sparse_masks() results. The query is never repeated per region.
+    """
+    b = q.shape[0]
+    out = torch.zeros_like(q)
+    for i, (indices, weights) in enumerate(regions):
+        if indices is not None and indices.shape[0] == 0:
+            continue
+        q_region = q if indices is None else q[:, indices]
+        k_region = k[i].unsqueeze(0).expand(b, -1, -1)
+        v_region = v[i].unsqueeze(0).expand(b, -1, -1)
+        qkv = optimized_attention(q_region, k_region, v_region, heads) * weights
+        if indices is None:
+            out += qkv
+        else:
+            out.index_add_(1, indices, qkv)
+    return out
+
+def copy_masked_conditioning(conditioning):
+    """
+    Shallow copy of a conditioning, with a copy of the first dict which attention_couple() modifies.
+    """
+    conditioning = list(conditioning)
+    if len(conditioning) != 1:
+        conditioning[0] = [conditioning[0][0], conditioning[0][1].copy()]
+    return conditioning
+
 def set_model_patch_replace(model, patch, key):
     to = model.model_options["transformer_options"]
     if "patches_replace" not in to:
@@ -47,34 +125,50 @@ class AttentionCoupleWildDivide:
                 "model": ("MODEL", ),
                 "positive": ("CONDITIONING",),
                 "negative": ("CONDITIONING",),
-                "mode": (["Attention", "Latent"], ),
+                "mode": (["Attention", "Latent", "Attention (sparse)"], ),
             }
         }
     RETURN_TYPES = ("MODEL", "CONDITIONING", "CONDITIONING")
     FUNCTION = "attention_couple"
     CATEGORY = "loaders"
 
-    def attention_couple(self, model, positive, negative, mode):
+    def attention_couple(self, model, positive, negative, mode, atlas=None):
+        """
+        :param atlas: MaskAtlas holding the masks of the positive conditionings, in order
+        """
         if mode == "Latent":
             return (model, positive, negative) # latent coupleの場合は何もしない
         
         self.negative_positive_masks = []
         self.negative_positive_conds = []
+        # (0: negative / 1: positive, original_shape, q tokens) -> get_masks_from_q()
+        self.mask_cache = {}
+        # (0: negative / 1: positive, original_shape, q tokens) -> get_sparse_masks()
+        self.sparse_mask_cache = {}
+        # attend only the query tokens each region covers, see sparse_attention()
+        self.sparse = mode == "Attention (sparse)"
+        
+        # positiveのマスクをatlasから取る場合 (get_masks)
+        self.atlas = atlas if atlas is not None and len(positive) != 1 and len(positive) == atlas.masks.shape[0] else None
         
-        new_positive = copy.deepcopy(positive)
-        new_negative = copy.deepcopy(negative)
+        # 書き換えるdictだけをコピーする
+        new_positive = copy_masked_conditioning(positive)
+        new_negative = copy_masked_conditioning(negative)
         
         dtype = model.model.diffusion_model.dtype
         device = comfy.model_management.get_torch_device()
+        if self.atlas is not None:
+            self.atlas_key = (tuple(cond[1]["mask_strength"] for cond in positive), device, dtype)
         
         # maskとcondをリストに格納する
         for conditions in [new_negative, new_positive]:
             conditions_masks = []
             conditions_conds = []
             if len(conditions) != 1:
-                mask_norm = torch.stack([cond[1]["mask"].to(device, dtype=dtype) * cond[1]["mask_strength"] for cond in conditions])
-                mask_norm = mask_norm / mask_norm.sum(dim=0) # 合計が1になるように正規化(他が0の場合mask_strengthの効果がなくなる)
-                conditions_masks.extend([mask_norm[i] for i in range(mask_norm.shape[0])])
+                if conditions is not new_positive or self.atlas is None:
+                    mask_norm = torch.stack([cond[1]["mask"].to(device, dtype=dtype) * cond[1]["mask_strength"] for cond in conditions])
+                    mask_norm = mask_norm / mask_norm.sum(dim=0) # 合計が1になるように正規化(他が0の場合mask_strengthの効果がなくなる)
+                    conditions_masks.extend([mask_norm[i] for i in range(mask_norm.shape[0])])
                 conditions_conds.extend([cond[0].to(device, dtype=dtype) for cond in conditions])
                 del conditions[0][1]["mask"] # latent coupleの無効化のため
                 del conditions[0][1]["mask_strength"]
@@ -107,7 +201,51 @@ class AttentionCoupleWildDivide:
         
         return (new_model, [new_positive[0]], [new_negative[0]]) # pool outputは・・・後回し
     
+    def get_masks(self, index, q, original_shape):
+        if index == 1 and self.atlas is not None:
+            return self.atlas.get_masks_from_q(*self.atlas_key, q, original_shape)
+        key = (index, tuple(original_shape), q.shape[1])
+        if key not in self.mask_cache:
+            self.mask_cache[key] = get_masks_from_q(self.negative_positive_masks[index], q, original_shape)
+        return self.mask_cache[key]
+
+    def get_sparse_masks(self, index, q, original_shape):
+        """
+        :return: (token indices, [tokens, 1] weights) of each region, indices are None when it covers all tokens
+        """
+        key = (index, tuple(original_shape), q.shape[1])
+        if key not in self.sparse_mask_cache:
+            masks = self.get_masks(index, q, original_shape)
+            regions = []
+            for mask in masks:
+                indices = mask[:, 0].nonzero().squeeze(1)
+                if indices.shape[0] == mask.shape[0]:
+                    regions.append((None, mask))
+                else:
+                    regions.append((indices, mask[indices]))
+            self.sparse_mask_cache[key] = regions
+        return self.sparse_mask_cache[key]
+
+    def get_kv(self, module, kv_cache, index, dtype):
+        """
+        Project the contexts of the negative (0) or positive (1) regions once per block.
+
+        The key includes the projection weights, which are replaced when the
+        model is patched again.
+        """
+        key = (index, dtype, module.to_k.weight.data_ptr(), module.to_k.weight._version,
+               module.to_v.weight.data_ptr(), module.to_v.weight._version)
+        if key not in kv_cache:
+            kv_cache.clear()
+            context = torch.cat([cond for cond in self.negative_positive_conds[index]], dim=0)
+            # Ensure all dtypes match
+            kv_cache[key] = (module.to_k(context).to(dtype), module.to_v(context).to(dtype))
+        return kv_cache[key]
+
     def make_patch(self, module):
+        # get_kv() results of this block
+        kv_caches = ({}, {})
+
         def patch(q, k, v, extra_options):
             
             len_neg, len_pos = self.conditioning_length # negative, positiveの長さ
@@ -115,52 +253,35 @@ class AttentionCoupleWildDivide:
             q_list = q.chunk(len(cond_or_uncond), dim=0)
             b = q_list[0].shape[0] # batch_size
             
-            masks_uncond = get_masks_from_q(self.negative_positive_masks[0], q_list[0], extra_options["original_shape"])
-            masks_cond = get_masks_from_q(self.negative_positive_masks[1], q_list[0], extra_options["original_shape"])
-
-            context_uncond = torch.cat([cond for cond in self.negative_positive_conds[0]], dim=0)
-            context_cond = torch.cat([cond for cond in self.negative_positive_conds[1]], dim=0)
-            
-            k_uncond = module.to_k(context_uncond)
-            k_cond = module.to_k(context_cond)
-            v_uncond = module.to_v(context_uncond)
-            v_cond = module.to_v(context_cond)
+            masks_uncond = self.get_masks(0, q_list[0], extra_options["original_shape"])
+            masks_cond = self.get_masks(1, q_list[0], extra_options["original_shape"])
 
             out = []
             for i, c in enumerate(cond_or_uncond):
                 if c == 0:
                     masks = masks_cond
-                    k = k_cond
-                    v = v_cond
+                    index = 1
                     length = len_pos
                 else:
                     masks = masks_uncond
-                    k = k_uncond
-                    v = v_uncond
+                    index = 0
                     length = len_neg
+                k, v = self.get_kv(module, kv_caches[index], index, q.dtype)
+
+                if self.sparse and masks is not None:
+                    regions = self.get_sparse_masks(index, q_list[0], extra_options["original_shape"])
+                    out.append(sparse_attention(q_list[i], k, v, regions, extra_options["n_heads"]))
+                    continue
 
                 q_target = q_list[i].repeat(length, 1, 1)
-                k = torch.cat([k[i].unsqueeze(0).repeat(b,1,1) for i in range(length)], dim=0)
-                v = torch.cat([v[i].unsqueeze(0).repeat(b,1,1) for i in range(length)], dim=0)
-                
-                if k.dtype != q_target.dtype or v.dtype != q_target.dtype:
-                    # Ensure all dtypes match
-                    k = k.to(q_target.dtype)
-                    v = v.to(q_target.dtype)
+                k = k.unsqueeze(1).expand(-1, b, -1, -1).reshape(length * b, k.shape[1], k.shape[2])
+                v = v.unsqueeze(1).expand(-1, b, -1, -1).reshape(length * b, v.shape[1], v.shape[2])
                 qkv = optimized_attention(q_target, k, v, extra_options["n_heads"])
                 
-                # Ensure masks match qkv tensor dimensions
-                if qkv.shape[1] != masks.shape[1]:
-                    if masks.shape[1] > qkv.shape[1]:
-                        masks = masks[:, :qkv.shape[1], :]
-                    else:
-                        pad_length = qkv.shape[1] - masks.shape[1]
-                        padding = torch.zeros((masks.shape[0], pad_length, masks.shape[2]), 
-                                            dtype=masks.dtype, device=masks.device)
-                        masks = torch.cat([masks, padding], dim=1)
-                
-                qkv = qkv * masks
-                qkv = qkv.view(length, b, -1, module.heads * module.dim_head).sum(dim=0)
+                qkv = qkv.view(length, b, -1, module.heads * module.dim_head)
+                if masks is not None:
+                    qkv = qkv * masks.unsqueeze(1)
+                qkv = qkv.sum(dim=0)
 
                 out.append(qkv)
 
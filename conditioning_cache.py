@@ -0,0 +1,110 @@
+# LRU cache of CLIP text encodings.
+#
+# Keys are built by the caller, see wildcards.clip_encode_key(). Entries are
+# conditionings as returned by CLIPTextEncode: [[cond, {"pooled_output": ...}], ...]
+import collections
+import threading
+import torch
+
+
+def map_tensors(conditioning, fn):
+    """
+    Copy a conditioning, applying fn to its tensors. The dicts are copied so callers can modify them.
+    """
+    result = []
+    for cond, extra in conditioning:
+        extra = {k: fn(v) if isinstance(v, torch.Tensor) else v for k, v in extra.items()}
+        result.append([fn(cond) if isinstance(cond, torch.Tensor) else cond, extra])
+    return result
+
+
+def conditioning_size(conditioning):
+    size = 0
+
+    def add(t):
+        nonlocal size
+        size += t.numel() * t.element_size()
+        return t
+
+    map_tensors(conditioning, add)
+    return size
+
+
+class ConditioningCache:
+    """
+    :param budget_mb: memory the cached tensors may use, 0 disables the cache
+    :param offload: keep the cached tensors on the CPU and move them back on a hit
+    """
+
+    def __init__(self, budget_mb, offload=False):
+        self.budget_mb = budget_mb
+        self.offload = offload
+        self.entries = collections.OrderedDict()  # key -> (conditioning, device, size)
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """
+        :return: copy of the cached conditioning, None on a miss
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+        conditioning, device, _ = entry
+        if device is not None:
+            return map_tensors(conditioning, lambda t: t.to(device))
+        return map_tensors(conditioning, lambda t: t)
+
+    def put(self, key, conditioning):
+        budget = self.budget_mb * 1024 * 1024
+        size = conditioning_size(conditioning)
+        if size > budget:
+            return
+
+        device = None
+        if self.offload:
+            devices = set()
+
+            def to_cpu(t):
+                devices.add(t.device)
+                return t.to("cpu")
+
+            conditioning = map_tensors(conditioning, to_cpu)
+            if len(devices) == 1 and next(iter(devices)).type != "cpu":
+                device = next(iter(devices))
+        else:
+            conditioning = map_tensors(conditioning, lambda t: t)
+
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= old[2]
+            self.entries[key] = (conditioning, device, size)
+            self.size += size
+            while self.size > budget:
+                _, (_, _, evicted_size) = self.entries.popitem(last=False)
+                self.size -= evicted_size
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self):
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "size_mb": self.size / (1024 * 1024),
+                "budget_mb": self.budget_mb,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
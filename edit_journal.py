@@ -0,0 +1,364 @@
+# Append-only journal of the edits of a file which is otherwise rewritten as a whole.
+#
+# Each edit is appended to path + ".journal" as one JSON line numbered by seq,
+# in the background. When the journal grows, the current state is written to
+# path as a snapshot whose first line holds the last seq it includes, and the
+# journal is cut down to the later edits. A crash loses at most the edits which
+# were not synced yet: a torn last line is dropped, and the edits which are
+# already in the snapshot are skipped when the journal is read.
+#
+# The journal starts with a header holding the seq and sha256 of the snapshot
+# its edits follow. A snapshot which was changed by hand since is taken as it
+# is, and the edits are dropped instead of being replayed onto it.
+import hashlib
+import io
+import json
+import os
+import threading
+import time
+from .atomic_file import write_file_atomic, sync_dir
+
+SNAPSHOT_HEADER = "# journal seq: "
+
+
+class EditJournal:
+    """
+    :param path: snapshot file
+    :param snapshot: callable() returning (seq, data) of the current state, or None to skip the compaction,
+                     called by the journal thread
+    :param write: callable(data, f) writing data into the open snapshot file f
+    :param fsync_interval: minimum seconds between fsyncs of the journal, 0 fsyncs every append, None never
+    :param compact_size: journal bytes after which a snapshot is written
+    :param default: json.dumps() default for the values in the records
+    """
+
+    def __init__(self, path, snapshot, write, fsync_interval=5, compact_size=1 << 20, default=None):
+        self.path = path
+        self.journal_path = path + ".journal"
+        self.snapshot = snapshot
+        self.write = write
+        self.fsync_interval = fsync_interval
+        self.compact_size = compact_size
+        self.default = default
+        self.condition = threading.Condition()
+        # held while the snapshot is replaced, readers of the snapshot hold it so it matches self.records
+        self.compaction_lock = threading.Lock()
+        self.seq = 0  # seq of the last record
+        self.written_seq = 0  # seq of the last record in the journal file
+        self.snapshot_seq = 0  # seq of the last record in the snapshot
+        self.snapshot_hash = None  # sha256 of the snapshot, None if there is none
+        self.snapshot_stat = None  # (size, mtime) of the snapshot when snapshot_hash was taken
+        self.dropped = False  # records were dropped by a compaction, see check_snapshot()
+        self.records = []  # records after snapshot_seq
+        self.pending = []  # records not written yet
+        self.size = 0  # bytes of the journal file
+        self.compact_at = compact_size
+        self.writing = False
+        self.unsynced = False  # written but not fsynced yet
+        self.last_fsync = 0
+        self.closed = False
+        self.thread = None
+
+    def open(self):
+        """
+        Read the journal. Call before the first append.
+
+        :return: records after the snapshot, in order
+        """
+        snapshot_seq = read_snapshot_seq(self.path)
+        self.snapshot_hash, self.snapshot_stat = read_snapshot_hash(self.path)
+        header = None
+        records = []
+        size = 0
+        try:
+            with open(self.journal_path, "rb") as f:
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        break
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        break
+                    size += len(line)
+                    if "snapshot" in record:
+                        header = record
+                    else:
+                        records.append(record)
+            if size < os.path.getsize(self.journal_path):
+                print(f"[WildDivide] Dropped the torn end of '{self.journal_path}'.")
+                with open(self.journal_path, "r+b") as f:
+                    f.truncate(size)
+        except FileNotFoundError:
+            pass
+        last_seq = max([snapshot_seq] + [record["seq"] for record in records])
+        if header is not None and header["sha256"] == self.snapshot_hash:
+            snapshot_seq = header["snapshot"]
+        elif header is not None and snapshot_seq <= header["snapshot"]:
+            # not a later snapshot written before a crash, so it was changed by hand
+            dropped = len([record for record in records if record["seq"] > header["snapshot"]])
+            if dropped:
+                print(f"[WildDivide] '{self.path}' was changed outside of WildDivide. "
+                      f"Skipped {dropped} changes of '{self.journal_path}' made before.")
+            snapshot_seq = last_seq
+        self.snapshot_seq = snapshot_seq
+        self.records = [record for record in records if record["seq"] > snapshot_seq]
+        self.seq = self.written_seq = last_seq
+        self.size = size
+        if size and (header != self.header() or len(self.records) < len(records)):
+            self.cut(self.records)
+        return self.records
+
+    def check_snapshot(self):
+        """
+        Check that the snapshot was not changed by hand since it was read or written.
+        If it was, the records are dropped and the journal follows the changed snapshot.
+        Call with compaction_lock held.
+
+        :return: False if the records were dropped, now or by a compaction since the last call
+        """
+        dropped, self.dropped = self.dropped, False
+        if stat_snapshot(self.path) == self.snapshot_stat:
+            return not dropped
+        snapshot_hash, snapshot_stat = read_snapshot_hash(self.path)
+        if snapshot_hash == self.snapshot_hash:
+            self.snapshot_stat = snapshot_stat
+            return not dropped
+        self.begin_write()
+        try:
+            with self.condition:
+                dropped = len(self.records)
+                self.records = []
+                self.pending = []
+                self.snapshot_seq = self.written_seq = self.seq
+            self.snapshot_hash, self.snapshot_stat = snapshot_hash, snapshot_stat
+            self.cut([])
+        finally:
+            self.end_write()
+        if dropped:
+            print(f"[WildDivide] '{self.path}' was changed outside of WildDivide. "
+                  f"Skipped {dropped} changes of '{self.journal_path}' made before.")
+        return False
+
+    def append(self, record):
+        """
+        Number the record and append it to the journal in the background.
+        The record must not be modified afterwards.
+
+        :return: seq of the record
+        """
+        with self.condition:
+            self.seq += 1
+            record["seq"] = self.seq
+            self.records.append(record)
+            self.pending.append(record)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+            self.condition.notify_all()
+            return self.seq
+
+    def flush(self):
+        """
+        Write the pending records now and fsync them. Returns when they are on disk.
+        """
+        with self.condition:
+            while self.writing:
+                self.condition.wait()
+            pending, self.pending = self.pending, []
+            unsynced = self.unsynced
+            self.writing = bool(pending) or unsynced
+        if not self.writing:
+            return
+        try:
+            if pending:
+                self.write_records(pending, True)
+            else:
+                self.sync()
+        finally:
+            with self.condition:
+                self.writing = False
+                self.condition.notify_all()
+
+    def close(self):
+        """
+        Stop compacting and write the pending records in the background. Does not wait for them,
+        so it can be called while a compaction is blocked on the snapshot callable.
+        """
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        threading.Thread(target=self.flush, daemon=False).start()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while True:
+                    now = time.monotonic()
+                    if self.writing:
+                        timeout = None
+                    elif self.pending or (self.size >= self.compact_at and not self.closed):
+                        break
+                    elif self.closed:
+                        return
+                    elif self.unsynced and self.fsync_interval is not None:
+                        timeout = self.last_fsync + self.fsync_interval - now
+                        if timeout <= 0:
+                            break
+                    else:
+                        timeout = None
+                    self.condition.wait(timeout)
+                pending, self.pending = self.pending, []
+                compact = not pending and self.size >= self.compact_at and not self.closed
+                if compact:
+                    self.compact_at = self.size + self.compact_size
+                else:
+                    self.writing = True
+            if compact:
+                # compact() waits for compaction_lock, whose holder may wait in check_snapshot()
+                # for the journal to be written, so it is not held for writing meanwhile
+                try:
+                    self.compact()
+                except Exception as e:
+                    print(f"[WildDivide] Failed to compact '{self.journal_path}'. {e}")
+                continue
+            try:
+                if pending:
+                    self.write_records(pending, False)
+                else:
+                    self.sync()
+            except Exception as e:
+                print(f"[WildDivide] Failed to write '{self.journal_path}'. {e}")
+            finally:
+                with self.condition:
+                    self.writing = False
+                    self.condition.notify_all()
+
+    def begin_write(self):
+        with self.condition:
+            while self.writing:
+                self.condition.wait()
+            self.writing = True
+
+    def end_write(self):
+        with self.condition:
+            self.writing = False
+            self.condition.notify_all()
+
+    def header(self):
+        return {"snapshot": self.snapshot_seq, "sha256": self.snapshot_hash}
+
+    def encode(self, records):
+        return "".join(json.dumps(record, default=self.default) + "\n" for record in records).encode("utf-8")
+
+    def write_records(self, records, fsync):
+        now = time.monotonic()
+        fsync = fsync or (self.fsync_interval is not None and now - self.last_fsync >= self.fsync_interval)
+        dir_path = os.path.dirname(self.journal_path)
+        if not os.path.exists(dir_path):
+            os.makedirs(dir_path)
+        created = not os.path.exists(self.journal_path)
+        data = self.encode([self.header()] + records if self.size == 0 else records)
+        with open(self.journal_path, "ab") as f:
+            f.write(data)
+            f.flush()
+            if fsync:
+                os.fsync(f.fileno())
+        if created:
+            sync_dir(dir_path)
+        if fsync:
+            self.last_fsync = now
+        self.unsynced = not fsync
+        self.size += len(data)
+        self.written_seq = records[-1]["seq"]
+
+    def sync(self):
+        with open(self.journal_path, "rb") as f:
+            os.fsync(f.fileno())
+        self.last_fsync = time.monotonic()
+        self.unsynced = False
+
+    def compact(self):
+        """
+        Write the current state to the snapshot and cut the journal down to the records after it.
+        Called by the journal thread, not while the journal is held for writing.
+
+        A snapshot which was changed by hand is not overwritten. The records are dropped
+        instead, and the next check_snapshot() reports it so its reader takes the changed file.
+        """
+        with self.compaction_lock:
+            if not self.check_snapshot():
+                self.dropped = True
+                return
+            snapshot = self.snapshot()
+            if snapshot is None:
+                return
+            seq, data = snapshot
+            f = io.StringIO()
+            f.write(f"{SNAPSHOT_HEADER}{seq}\n")
+            self.write(data, f)
+            content = f.getvalue().encode("utf-8")
+            write_file_atomic(self.path, content)
+            self.begin_write()
+            try:
+                with self.condition:
+                    self.snapshot_seq = seq
+                    self.records = [record for record in self.records if record["seq"] > seq]
+                    written = [record for record in self.records if record["seq"] <= self.written_seq]
+                self.snapshot_hash = hashlib.sha256(content).hexdigest()
+                self.snapshot_stat = stat_snapshot(self.path)
+                self.cut(written)
+                self.compact_at = self.compact_size
+            finally:
+                self.end_write()
+        print(f"[WildDivide] Compacted '{self.journal_path}' into '{self.path}'.")
+
+    def cut(self, records):
+        """
+        Replace the journal with the header of the current snapshot and the records.
+        Call with the journal held for writing, or before the first append.
+        """
+        data = self.encode([self.header()] + records)
+        write_file_atomic(self.journal_path, data)
+        self.size = len(data)
+        self.last_fsync = time.monotonic()
+        self.unsynced = False
+
+
+def read_snapshot_hash(path):
+    """
+    :return: (sha256 of the snapshot, stat_snapshot() of it), (None, None) if there is none
+    """
+    try:
+        with open(path, "rb") as f:
+            stat = os.fstat(f.fileno())
+            return hashlib.sha256(f.read()).hexdigest(), (stat.st_size, stat.st_mtime_ns)
+    except FileNotFoundError:
+        return None, None
+
+
+def stat_snapshot(path):
+    """
+    :return: (size, mtime) of the snapshot, None if there is none
+    """
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_size, stat.st_mtime_ns
+
+
+def read_snapshot_seq(path):
+    """
+    :return: the last seq included in the snapshot, 0 if it has none
+    """
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            line = f.readline()
+    except (FileNotFoundError, UnicodeDecodeError):
+        return 0
+    if not line.startswith(SNAPSHOT_HEADER):
+        return 0
+    try:
+        return int(line[len(SNAPSHOT_HEADER):])
+    except ValueError:
+        return 0
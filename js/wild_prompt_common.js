@@ -16,7 +16,7 @@ export function get_generator_node() {
 }
 
 export async function load_wildcards() {
-    let res = await api.fetchApi("/wilddivide/wildcards/dict");
+    let res = await api.fetchApi("/wilddivide/wildcards/dict?prefix=m/");
     let data = await res.json();
     wildcards_dict = data.data;
     return wildcards_dict;
@@ -0,0 +1,349 @@
+# Ordered tree of the m/ menu: groups hold their slots and subgroups in a
+# doubly linked list, and every node is found by its key, so inserting,
+# removing, moving and renaming a slot does not touch the other slots.
+#
+# Keys are the flat wildcard keys ("m/slot", "m/group/slot"), a group's key is
+# the prefix of its slots ("m/group"). The order of the flat keys is the
+# depth-first order of the tree, see MenuTree.items().
+#
+# Every edit is recorded as ops, lists of a method name and its arguments which
+# apply() replays, together with the ops which revert it, see take_ops().
+
+
+def parent_key(key):
+    return key.rpartition('/')[0]
+
+
+class MenuNode:
+    """
+    A slot, holding the values of its key, or a group, holding child nodes.
+    """
+    __slots__ = ("key", "value", "is_group", "parent", "prev", "next", "first", "last")
+
+    def __init__(self, key, value=None, is_group=False):
+        self.key = key
+        self.value = value
+        self.is_group = is_group
+        self.parent = None
+        self.prev = None
+        self.next = None
+        self.first = None
+        self.last = None
+
+    def children(self):
+        node = self.first
+        while node is not None:
+            yield node
+            node = node.next
+
+
+class MenuTree:
+    def __init__(self, root_key="m"):
+        self.root = MenuNode(root_key, is_group=True)
+        self.slots = {}  # key -> MenuNode
+        self.groups = {root_key: self.root}  # key -> MenuNode
+        self.ops = []  # ops of the edits since take_ops()
+        self.undo_ops = []  # ops reverting each of self.ops, in the same order
+
+    @classmethod
+    def from_items(cls, items, root_key="m"):
+        """
+        :param items: (key, values) of the slots, keys must start with root_key + '/'
+        """
+        tree = cls(root_key)
+        for k, v in items:
+            node = MenuNode(k, v)
+            tree.link(node, tree.group(parent_key(k)))
+            tree.slots[k] = node
+        return tree
+
+    def __contains__(self, key):
+        return key in self.slots
+
+    def get(self, key, default=None):
+        node = self.slots.get(key)
+        return default if node is None else node.value
+
+    def items(self):
+        """
+        :return: iterator of (key, values) of the slots in depth-first order
+        """
+        return self.subtree_items(self.root)
+
+    def subtree_items(self, node):
+        """
+        :return: iterator of (key, values) of the slots in and below node in depth-first order
+        """
+        if not node.is_group:
+            yield node.key, node.value
+            return
+        stack = [node.first]
+        while stack:
+            n = stack.pop()
+            if n is None:
+                continue
+            stack.append(n.next)
+            if n.is_group:
+                stack.append(n.first)
+            else:
+                yield n.key, n.value
+
+    def first_slot(self, key):
+        """
+        :return: key of the first slot in the group, None if it has none
+        """
+        group = self.groups.get(key)
+        if group is None:
+            return None
+        return next((k for k, _ in self.subtree_items(group)), None)
+
+    def last_slot_child(self, key):
+        """
+        :return: key of the last slot directly in the group, None if it has none
+        """
+        group = self.groups.get(key)
+        node = group.last if group is not None else None
+        while node is not None and node.is_group:
+            node = node.prev
+        return node.key if node is not None else None
+
+    def node(self, key):
+        """
+        :param key: key of a slot, else of a group, or [key, is_group]
+        """
+        if not isinstance(key, str):
+            key, is_group = key
+            return self.groups[key] if is_group else self.slots[key]
+        node = self.slots.get(key)
+        return node if node is not None else self.groups[key]
+
+    @staticmethod
+    def ref(node):
+        """
+        :return: [key, is_group] of the node for node(), None for None
+        """
+        return None if node is None else [node.key, node.is_group]
+
+    def group(self, key):
+        """
+        :return: group node of the key, created at the end of its parent if it does not exist
+        """
+        node = self.groups.get(key)
+        if node is None:
+            node = MenuNode(key, is_group=True)
+            self.link(node, self.group(parent_key(key)))
+            self.groups[key] = node
+        return node
+
+    def add(self, key, value, before=None, after=None):
+        """
+        Add a slot, or replace the values of an existing slot in place.
+
+        Without before or after it is placed after the last slot directly in its
+        group, or at the end of the group when it has none.
+
+        :param before: key of a slot or group in the same group to place the slot before
+        :param after: key of a slot or group in the same group to place the slot after
+        """
+        if key in self.slots:
+            node = self.slots[key]
+            self.record(["add", key, value, None, None], ["add", key, node.value, None, None])
+            node.value = value
+            return
+        self.record(["add", key, value, before, after], ["remove", key, False])
+        parent = self.group(parent_key(key))
+        node = MenuNode(key, value)
+        if before is not None:
+            next_node = self.node(before)
+        elif after is not None:
+            next_node = self.node(after).next
+        else:
+            last_slot = self.slots.get(self.last_slot_child(parent.key))
+            next_node = last_slot.next if last_slot is not None else None
+        self.link(node, parent, next_node)
+        self.slots[key] = node
+
+    def remove(self, key, is_group=False):
+        """
+        Remove a slot, or a group with everything in it. Groups left empty are removed too.
+
+        :return: keys of the removed slots
+        """
+        node = self.groups[key] if is_group else self.slots[key]
+        # the topmost node removed, counting the groups left empty
+        top = node
+        while top.parent is not self.root and top.parent.first is top.parent.last:
+            top = top.parent
+        if top.is_group:
+            value = [[k, v] for k, v in self.subtree_items(top)]
+        else:
+            value = top.value
+        self.record(["remove", key, is_group], ["restore", top.key, top.is_group, value, self.ref(top.next)])
+
+        removed = []
+        for n in self.subtree_nodes(node):
+            if n.is_group:
+                del self.groups[n.key]
+            else:
+                del self.slots[n.key]
+                removed.append(n.key)
+        parent = node.parent
+        self.unlink(node)
+        self.prune(parent)
+        return removed
+
+    def rename(self, key, new_key, is_group=False):
+        """
+        Rename a slot or a group. It keeps its place when the group it is in stays the same,
+        otherwise it is added to the new group. A renamed slot replaces the slot of new_key
+        and a renamed group is merged into the group of new_key.
+
+        :return: (old key, new key) of the renamed slots
+        """
+        node = self.groups[key] if is_group else self.slots[key]
+        if key == new_key:
+            return []
+        existing = (self.groups if is_group else self.slots).get(new_key)
+        if parent_key(new_key) != parent_key(key) or (is_group and existing is not None):
+            items = [(k, new_key + k[len(key):], v) for k, v in self.subtree_items(node)]
+            self.remove(key, is_group)
+            for _, k, v in items:
+                self.add(k, v)
+            return [(old_k, k) for old_k, k, _ in items]
+
+        if existing is not None:
+            self.remove(new_key)
+        self.record(["rename", key, new_key, is_group], ["rename", new_key, key, is_group])
+        renamed = []
+        for n in self.subtree_nodes(node):
+            old_key = n.key
+            n.key = new_key + old_key[len(key):]
+            if n.is_group:
+                del self.groups[old_key]
+                self.groups[n.key] = n
+            else:
+                del self.slots[old_key]
+                self.slots[n.key] = n
+                renamed.append((old_key, n.key))
+        return renamed
+
+    def move(self, key, before=None, after=None, is_group=False):
+        """
+        Move a slot or a group within its group, before or after a sibling, to the front
+        when neither is given.
+        """
+        node = self.groups[key] if is_group else self.slots[key]
+        parent = node.parent
+        target_key = before if before is not None else after
+        target = self.node(target_key) if target_key is not None else None
+        if target is node:
+            return
+        self.record(["move", key, before, after, is_group], ["move", key, None, self.ref(node.prev), is_group])
+        self.unlink(node)
+        if before is not None:
+            self.link(node, parent, target)
+        elif after is not None:
+            self.link(node, parent, target.next)
+        else:
+            self.link(node, parent, parent.first)
+
+    def restore(self, key, is_group, value, before=None):
+        """
+        Put back a slot or a group removed by remove().
+
+        :param value: values of the slot, or (key, values) of the slots of the group
+        :param before: node() key of the node it was before, None if it was the last one
+        """
+        if not is_group:
+            if before is None:
+                group = self.groups.get(parent_key(key))
+                self.add(key, value, after=self.ref(group.last if group is not None else None))
+            else:
+                self.add(key, value, before=before)
+            return
+        self.record(["restore", key, is_group, value, before], ["remove", key, True])
+        node = MenuNode(key, is_group=True)
+        self.link(node, self.group(parent_key(key)), self.node(before) if before is not None else None)
+        self.groups[key] = node
+        for k, v in value:
+            n = MenuNode(k, v)
+            self.link(n, self.group(parent_key(k)))
+            self.slots[k] = n
+
+    def apply(self, op):
+        """
+        Replay an op of take_ops().
+        """
+        getattr(self, op[0])(*op[1:])
+
+    def record(self, op, undo_op):
+        self.ops.append(op)
+        self.undo_ops.append(undo_op)
+
+    def take_ops(self):
+        """
+        :return: (ops of the edits since the last call, ops reverting them in the order to apply them)
+        """
+        ops, undo_ops = self.ops, self.undo_ops[::-1]
+        self.ops = []
+        self.undo_ops = []
+        return ops, undo_ops
+
+    def subtree_nodes(self, node):
+        stack = [node]
+        while stack:
+            n = stack.pop()
+            yield n
+            if n.is_group:
+                stack.extend(n.children())
+
+    def to_nested(self, get_value=lambda x: x):
+        """
+        :return: nested dicts of the groups, as saved in m.yaml
+        """
+        def nested(group):
+            result = {}
+            for node in group.children():
+                name = node.key.rpartition('/')[2]
+                result[name] = nested(node) if node.is_group else get_value(node.value)
+            return result
+
+        return {self.root.key: nested(self.root)}
+
+    @staticmethod
+    def link(node, parent, next_node=None):
+        """
+        Link node into parent before next_node, at the end when it is None.
+        """
+        node.parent = parent
+        node.next = next_node
+        if next_node is None:
+            node.prev = parent.last
+            parent.last = node
+        else:
+            node.prev = next_node.prev
+            next_node.prev = node
+        if node.prev is None:
+            parent.first = node
+        else:
+            node.prev.next = node
+
+    @staticmethod
+    def unlink(node):
+        parent = node.parent
+        if node.prev is None:
+            parent.first = node.next
+        else:
+            node.prev.next = node.next
+        if node.next is None:
+            parent.last = node.prev
+        else:
+            node.next.prev = node.prev
+        node.parent = node.prev = node.next = None
+
+    def prune(self, group):
+        while group is not self.root and group.first is None:
+            parent = group.parent
+            del self.groups[group.key]
+            self.unlink(group)
+            group = parent
@@ -9,6 +9,7 @@
 #              |  '(' pattern ')'
 # string := [^|&~()]+
 import re
+import functools
 
 class PatternNode:
     def __init__(self, type, value=None, left=None, right=None):
@@ -40,10 +41,11 @@ class PatternParser:
     
     def parse_string(self):
         self.skip_whitespace()
-        result = ""
+        start = self.pos
         # Any character except |, &, ~, (, ) is allowed
-        while self.peek() and self.peek() not in '|&~()':
-            result += self.consume()
+        while self.pos < len(self.pattern) and self.pattern[self.pos] not in '|&~()':
+            self.pos += 1
+        result = self.pattern[start:self.pos]
         if not result:
             raise ValueError(f"Expected string at position {self.pos}")
         return PatternNode("TERM", value=result)
@@ -136,4 +138,50 @@ def evaluate_pattern(node, values):
     elif node.type == "OR":
         return evaluate_pattern(node.left, values) or evaluate_pattern(node.right, values)
     else:
-        raise ValueError(f"Unknown node type: {node.type}")
\ No newline at end of file
+        raise ValueError(f"Unknown node type: {node.type}")
+
+
+@functools.lru_cache(maxsize=4096)
+def compile_pattern(pattern):
+    """
+    Compile a pattern string into a predicate. Cached by the pattern text.
+
+    Args:
+        pattern (str): Pattern string to compile
+
+    Returns:
+        callable: predicate(values) -> bool, same result as
+            evaluate_pattern(parse_pattern(pattern), values)
+    """
+    return compile_node(parse_pattern(pattern))
+
+
+def compile_node(node):
+    """
+    Compile a parsed pattern tree into a predicate with pre-compiled TERM regexes.
+    AND and OR short-circuit like evaluate_pattern.
+    """
+    if node.type == "TERM":
+        try:
+            search = re.compile(node.value, re.IGNORECASE).search
+        except re.error as e:
+            # raise when the term is evaluated, like evaluate_pattern does
+            error = e
+
+            def term(values):
+                raise error
+            return term
+        return lambda values: search(values) is not None
+    elif node.type == "NOT":
+        left = compile_node(node.left)
+        return lambda values: not left(values)
+    elif node.type == "AND":
+        left = compile_node(node.left)
+        right = compile_node(node.right)
+        return lambda values: left(values) and right(values)
+    elif node.type == "OR":
+        left = compile_node(node.left)
+        right = compile_node(node.right)
+        return lambda values: left(values) or right(values)
+    else:
+        raise ValueError(f"Unknown node type: {node.type}")
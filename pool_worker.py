@@ -0,0 +1,14 @@
+# Run by runpy.run_path() in each new worker of process_pool.worker_pool(),
+# with package_name, package_path, initializer and initargs as globals.
+import importlib
+import sys
+import types
+
+if package_name not in sys.modules:
+    package = types.ModuleType(package_name)
+    package.__path__ = [package_path]
+    sys.modules[package_name] = package
+
+if initializer is not None:
+    module_name, function_name = initializer
+    getattr(importlib.import_module(module_name), function_name)(*initargs)
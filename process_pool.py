@@ -0,0 +1,43 @@
+# Process pools which do not fork the server process.
+#
+# The server process runs threads which may hold a lock at any moment, and a
+# forked child inherits such a lock held forever. The workers are started from
+# a forkserver, or spawned where there is none, so they begin with no threads.
+#
+# ComfyUI loads this package under a name which the workers cannot import, so
+# every worker first runs pool_worker.py, which registers the package without
+# running its __init__.py. The functions and arguments the workers get are then
+# unpickled by importing only the modules they are defined in.
+#
+# Like every forkserver or spawn child, the forkserver or each worker first runs
+# the top level of the host's __main__ again as __mp_main__. In ComfyUI that is
+# main.py, which imports torch and the nodes, so the pools are off by default.
+import concurrent.futures
+import multiprocessing
+import os
+import runpy
+
+POOL_WORKER_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "pool_worker.py")
+
+
+def start_method():
+    return "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+
+
+def worker_pool(workers, initializer=None, initargs=()):
+    """
+    :param workers: number of worker processes, at most os.cpu_count() are started
+    :param initializer: function run in each worker with initargs, defined in a module of this package
+    :return: ProcessPoolExecutor
+    """
+    workers = max(1, min(workers, os.cpu_count() or 1))
+    init_globals = {
+        "package_name": __package__,
+        "package_path": os.path.dirname(POOL_WORKER_FILE),
+        "initializer": None if initializer is None else (initializer.__module__, initializer.__qualname__),
+        "initargs": initargs,
+    }
+    return concurrent.futures.ProcessPoolExecutor(max_workers=workers,
+                                                  mp_context=multiprocessing.get_context(start_method()),
+                                                  initializer=runpy.run_path,
+                                                  initargs=(POOL_WORKER_FILE, init_globals))
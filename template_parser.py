@@ -0,0 +1,122 @@
+# parse wildcard template into option groups
+# template := (text | group)*
+# group := '{' template '}'
+# text := [^{}]+
+# Unbalanced '{' and '}' are kept as text.
+# Wildcards (__name__) are tokenized after the groups are resolved, because a
+# group can select or assemble the name of a wildcard.
+import re
+
+RE_Wildcard = re.compile(r"__([\w.\-+/*\\]+?)__")
+RE_Brace = re.compile(r"([{}])")
+
+
+class Template:
+    def __init__(self, parts, groups, order):
+        self.parts = parts  # root parts, str or index of a group
+        self.groups = groups  # parts of each group
+        self.order = order  # group indices in resolution order
+        self.tokens = tokenize_wildcards(parts[0] if parts else "") if not groups else None
+
+
+def tokenize_wildcards(text):
+    """
+    Split text into literal and wildcard tokens.
+
+    Returns:
+        list: ("TEXT", str) and ("WILDCARD", name) tuples in text order
+
+    Example:
+        "a __b__ c" -> [("TEXT", "a "), ("WILDCARD", "b"), ("TEXT", " c")]
+    """
+    tokens = []
+    pos = 0
+    for match in RE_Wildcard.finditer(text):
+        if match.start() > pos:
+            tokens.append(("TEXT", text[pos:match.start()]))
+        tokens.append(("WILDCARD", match.group(1)))
+        pos = match.end()
+    if pos < len(text):
+        tokens.append(("TEXT", text[pos:]))
+    return tokens
+
+
+def parse_template(text):
+    """
+    Parse a template into a tree of option groups.
+
+    Groups are ordered the way repeated innermost-first substitution would
+    visit them: by nesting height, then from left to right.
+
+    Args:
+        text (str): Template string to parse
+
+    Returns:
+        Template: parsed template
+
+    Example:
+        "a{b|{c|d}}" -> parts=["a", 1], groups=[["c|d"], ["b|", 0]], order=[0, 1]
+    """
+    groups = []
+    heights = []
+    starts = []
+    # frame: [parts, start, height of the highest child group]
+    stack = [[[], 0, 0]]
+    pos = 0
+    for piece in RE_Brace.split(text):
+        if piece == "{":
+            stack.append([[], pos, 0])
+        elif piece == "}" and len(stack) > 1:
+            parts, start, height = stack.pop()
+            groups.append(parts)
+            heights.append(height + 1)
+            starts.append(start)
+            stack[-1][0].append(len(groups) - 1)
+            stack[-1][2] = max(stack[-1][2], height + 1)
+        elif piece:
+            stack[-1][0].append(piece)
+        pos += len(piece)
+
+    # unclosed '{' are plain text
+    while len(stack) > 1:
+        parts, _, height = stack.pop()
+        stack[-1][0].append("{")
+        stack[-1][0].extend(parts)
+        stack[-1][2] = max(stack[-1][2], height)
+
+    order = sorted(range(len(groups)), key=lambda i: (heights[i], starts[i]))
+    return Template(merge_text(stack[0][0]), [merge_text(parts) for parts in groups], order)
+
+
+def merge_text(parts):
+    merged = []
+    for part in parts:
+        if isinstance(part, str) and merged and isinstance(merged[-1], str):
+            merged[-1] += part
+        else:
+            merged.append(part)
+    return merged
+
+
+def resolve_template(template, choose_option):
+    """
+    Resolve the option groups of a parsed template.
+
+    Args:
+        template (Template): parsed template
+        choose_option (callable): receives the body of a group with its inner
+            groups already resolved, returns the replacement string
+
+    Returns:
+        str: template text with all groups replaced
+    """
+    if not template.groups:
+        return template.parts[0] if template.parts else ""
+
+    def join(parts):
+        return "".join(part if isinstance(part, str) else results[part] for part in parts)
+
+    results = [None] * len(template.groups)
+    for i in template.order:
+        results[i] = choose_option(join(template.groups[i]))
+    return join(template.parts)
@@ -0,0 +1,65 @@
+# Lets the tests import the modules of this package without a running ComfyUI.
+#
+# The package __init__.py registers the nodes and routes with the ComfyUI
+# server, so it must not run. The package is registered under the name pytest
+# imports it by, which makes pytest use it instead of running __init__.py, and
+# under "wilddivide" for the tests. The ComfyUI modules wildcards.py imports
+# are stubbed when they are not loaded yet.
+import os
+import sys
+import types
+
+PACKAGE_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def package_name(path):
+    """
+    :return: module name pytest gives the package at path, see _pytest.pathlib.resolve_pkg_root_and_module_name()
+    """
+    names = [os.path.basename(path)]
+    path = os.path.dirname(path)
+    while os.path.isfile(os.path.join(path, "__init__.py")):
+        names.insert(0, os.path.basename(path))
+        path = os.path.dirname(path)
+    return ".".join(names)
+
+
+def register_package():
+    package = sys.modules.get("wilddivide")
+    if package is None:
+        package = types.ModuleType("wilddivide")
+        package.__path__ = [PACKAGE_PATH]
+        package.__file__ = os.path.join(PACKAGE_PATH, "__init__.py")
+        sys.modules["wilddivide"] = package
+    sys.modules.setdefault(package_name(PACKAGE_PATH), package)
+
+
+def stub_module(name, **attributes):
+    if name in sys.modules:
+        return
+    module = types.ModuleType(name)
+    module.__dict__.update(attributes)
+    sys.modules[name] = module
+
+
+class ComfyNode:
+    def __init__(self, *args, **kwargs):
+        raise RuntimeError("ComfyUI nodes are not available in the tests")
+
+
+stub_module(
+    "folder_paths",
+    supported_pt_extensions={".ckpt", ".pt", ".bin", ".pth", ".safetensors"},
+    filename_list_cache={},
+    get_filename_list=lambda folder_name: [],
+    get_folder_paths=lambda folder_name: [],
+    get_full_path=lambda folder_name, filename: None,
+)
+stub_module(
+    "nodes",
+    NODE_CLASS_MAPPINGS={},
+    CLIPTextEncode=ComfyNode,
+    ConditioningConcat=ComfyNode,
+    LoraLoader=ComfyNode,
+)
+register_package()
@@ -0,0 +1,191 @@
+import json
+import os
+import shutil
+import time
+
+import pytest
+
+from wilddivide import wildcards
+from wilddivide.edit_journal import EditJournal, SNAPSHOT_HEADER, read_snapshot_seq
+
+
+class State:
+    """
+    A list of strings edited by records {"add": value}, journaled to path.
+    """
+
+    def __init__(self, path, compact_size=1 << 20):
+        self.path = path
+        self.values = read_snapshot(path)
+        self.journal = EditJournal(path, self.snapshot, write_values, 0, compact_size)
+        for record in self.journal.open():
+            self.values.append(record["add"])
+
+    def snapshot(self):
+        return self.journal.seq, list(self.values)
+
+    def add(self, value):
+        self.values.append(value)
+        self.journal.append({"add": value})
+
+
+def write_values(values, f):
+    json.dump(values, f)
+
+
+def read_snapshot(path):
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.loads("".join(line for line in f if not line.startswith("#")))
+    except FileNotFoundError:
+        return []
+
+
+def test_records_are_replayed_after_reopen(tmp_path):
+    path = str(tmp_path / "state.json")
+    state = State(path)
+    for i in range(5):
+        state.add(f"v{i}")
+    state.journal.flush()
+    assert State(path).values == ["v0", "v1", "v2", "v3", "v4"]
+
+
+def test_torn_last_record_is_dropped(tmp_path):
+    path = str(tmp_path / "state.json")
+    state = State(path)
+    state.add("a")
+    state.journal.flush()
+    with open(path + ".journal", "ab") as f:
+        f.write(b'{"add": "b", "se')
+    reopened = State(path)
+    assert reopened.values == ["a"]
+    reopened.add("c")
+    reopened.journal.flush()
+    assert State(path).values == ["a", "c"]
+
+
+def test_compaction_writes_snapshot_and_cuts_journal(tmp_path):
+    path = str(tmp_path / "state.json")
+    state = State(path)
+    for i in range(3):
+        state.add(f"v{i}")
+    state.journal.flush()
+    state.journal.compact()
+    assert read_snapshot_seq(path) == 3
+    assert read_snapshot(path) == ["v0", "v1", "v2"]
+    state.add("v3")
+    state.journal.flush()
+    reopened = State(path)
+    assert reopened.journal.records == [{"add": "v3", "seq": 4}]
+    assert reopened.values == ["v0", "v1", "v2", "v3"]
+
+
+def test_compaction_in_background_when_journal_grows(tmp_path):
+    path = str(tmp_path / "state.json")
+    state = State(path, compact_size=200)
+    for i in range(50):
+        state.add(f"value {i}")
+    state.journal.flush()
+    for _ in range(500):
+        if read_snapshot_seq(path):
+            break
+        time.sleep(0.01)
+    with state.journal.compaction_lock:
+        assert read_snapshot_seq(path) > 0
+        assert os.path.getsize(path + ".journal") < 50 * len(b'{"add": "value 00", "seq": 00}\n')
+    assert State(path).values == [f"value {i}" for i in range(50)]
+
+
+def test_crash_between_snapshot_and_cut(tmp_path):
+    path = str(tmp_path / "state.json")
+    state = State(path)
+    for i in range(3):
+        state.add(f"v{i}")
+    state.journal.flush()
+    shutil.copy(path + ".journal", str(tmp_path / "old.journal"))
+    state.journal.compact()
+    shutil.copy(str(tmp_path / "old.journal"), path + ".journal")
+    assert State(path).values == ["v0", "v1", "v2"]
+
+
+def test_snapshot_edited_by_hand_is_not_replayed_onto(tmp_path, capsys):
+    path = str(tmp_path / "state.json")
+    state = State(path)
+    state.add("a")
+    state.journal.flush()
+    state.journal.compact()
+    state.add("b")
+    state.journal.flush()
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(["hand"], f)
+    reopened = State(path)
+    assert reopened.values == ["hand"]
+    assert "changed outside of WildDivide" in capsys.readouterr().out
+    reopened.add("c")
+    reopened.journal.flush()
+    assert State(path).values == ["hand", "c"]
+
+
+def test_compaction_keeps_snapshot_edited_by_hand(tmp_path):
+    path = str(tmp_path / "state.json")
+    state = State(path)
+    state.add("a")
+    state.journal.flush()
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(["hand"], f)
+    state.add("b")
+    state.journal.flush()
+    state.journal.compact()
+    assert read_snapshot(path) == ["hand"]
+    with state.journal.compaction_lock:
+        assert not state.journal.check_snapshot()
+        assert state.journal.check_snapshot()
+    assert state.journal.records == []
+
+
+@pytest.fixture
+def wildcard_dirs(tmp_path, monkeypatch):
+    user = tmp_path / "user"
+    user.mkdir()
+    (user / "a.txt").write_text("x\ny\n")
+    default = tmp_path / "default"
+    default.mkdir()
+    (default / "m.yaml").write_text(f"{SNAPSHOT_HEADER}0\nm:\n  scene:\n  - s\n")
+    monkeypatch.setattr(wildcards, "wildcards_path", str(user))
+    monkeypatch.setattr(wildcards, "default_wildcards_path", str(default))
+    monkeypatch.setattr(wildcards, "WILDCARD_DICT_FILE", str(default / "m.yaml"))
+    monkeypatch.setattr(wildcards, "EAGER_WILDCARD_LOAD", True)
+    monkeypatch.setattr(wildcards, "wildcard_cache", None)
+    monkeypatch.setattr(wildcards, "wildcard_journal", None)
+    monkeypatch.setattr(wildcards, "wildcard_menu_history", [])
+    wildcards.wildcard_load()
+    yield
+    wildcards.flush_wildcard_dict()
+
+
+def restart():
+    wildcards.flush_wildcard_dict()
+    wildcards.wildcard_journal = None
+    wildcards.wildcard_load()
+
+
+def menu():
+    return [(k, v) for k, v in wildcards.get_wildcard_dict().items() if k.startswith("m/")]
+
+
+def test_slot_edits_and_undo_survive_restart(wildcard_dirs):
+    wildcards.add_slot("g/one", "- 1")
+    wildcards.add_slot("two", "- 2")
+    wildcards.rename_slot("two", "g/three")
+    edited = menu()
+    restart()
+    assert menu() == edited
+    assert wildcards.undo_edit()
+    assert menu() == [("m/scene", ["s"]), ("m/two", ["2"]), ("m/g/one", ["1"])]
+    restart()
+    assert wildcards.undo_edit()
+    assert wildcards.undo_edit()
+    assert not wildcards.undo_edit()
+    assert menu() == [("m/scene", ["s"])]
+    restart()
+    assert menu() == [("m/scene", ["s"])]
@@ -0,0 +1,92 @@
+import random
+
+from wilddivide.menu_tree import MenuTree
+
+ITEMS = [
+    ("m/scene", ["s"]),
+    ("m/g1/slot", ["v1", "v2"]),
+    ("m/g1/other", ["o"]),
+    ("m/g1/s/x", ["x"]),
+    ("m/g2/slot", ["w"]),
+]
+NAMES = ["m/a", "m/b", "m/g1/a", "m/g1/b", "m/g2/c", "m/g1/s/x", "m/g2/s/y", "m/g1/slot", "m/scene"]
+GROUPS = ["m/g1", "m/g2", "m/g1/s", "m/g3"]
+
+
+def random_edit(tree, rnd, i):
+    op = rnd.randrange(6)
+    key, other = rnd.choice(NAMES), rnd.choice(NAMES)
+    try:
+        if op == 0:
+            before = other if rnd.random() < 0.5 and other.rpartition("/")[0] == key.rpartition("/")[0] else None
+            tree.add(key, [f"v{i}"], before=before if before in tree and before != key else None)
+        elif op == 1:
+            tree.remove(key)
+        elif op == 2:
+            tree.rename(key, other)
+        elif op == 3:
+            group, new_group = rnd.choice(GROUPS), rnd.choice(GROUPS)
+            if not new_group.startswith(group + "/"):
+                tree.rename(group, new_group, is_group=True)
+        elif op == 4:
+            sibling = rnd.choice(list(tree.groups[key.rpartition("/")[0]].children())).key
+            tree.move(key, before=sibling if rnd.random() < 0.5 else None)
+        else:
+            tree.remove(rnd.choice(GROUPS), is_group=True)
+    except KeyError:
+        pass
+
+
+def test_add_places_slot_after_last_slot_of_its_group():
+    tree = MenuTree.from_items(ITEMS)
+    tree.add("m/g1/new", ["n"])
+    tree.add("m/g1/first", ["f"], before="m/g1/slot")
+    assert [k for k, _ in tree.items()] == [
+        "m/scene", "m/g1/first", "m/g1/slot", "m/g1/other", "m/g1/new", "m/g1/s/x", "m/g2/slot"]
+
+
+def test_removing_last_slot_removes_empty_groups():
+    tree = MenuTree.from_items(ITEMS)
+    assert tree.remove("m/g1/s/x") == ["m/g1/s/x"]
+    assert "m/g1/s" not in tree.groups
+    tree.remove("m/g2/slot")
+    assert "m/g2" not in tree.groups
+
+
+def test_rename_group_keeps_place():
+    tree = MenuTree.from_items(ITEMS)
+    renamed = tree.rename("m/g1", "m/h", is_group=True)
+    assert ("m/g1/s/x", "m/h/s/x") in renamed
+    assert [k for k, _ in tree.items()] == ["m/scene", "m/h/slot", "m/h/other", "m/h/s/x", "m/g2/slot"]
+
+
+def test_ops_replay_and_undo():
+    for trial in range(200):
+        rnd = random.Random(trial)
+        tree = MenuTree.from_items(ITEMS)
+        replica = MenuTree.from_items(ITEMS)
+        states = [list(tree.items())]
+        history = []
+        for i in range(rnd.randrange(1, 12)):
+            random_edit(tree, rnd, i)
+            ops, undo_ops = tree.take_ops()
+            if not ops:
+                continue
+            for op in ops:
+                replica.apply(op)
+            assert list(replica.items()) == list(tree.items())
+            history.append(undo_ops)
+            states.append(list(tree.items()))
+        while history:
+            states.pop()
+            for op in history.pop():
+                tree.apply(op)
+            tree.take_ops()
+            assert list(tree.items()) == states[-1], trial
+
+
+def test_to_nested_round_trips_through_items():
+    tree = MenuTree.from_items(ITEMS)
+    nested = tree.to_nested()
+    assert nested == {"m": {"scene": ["s"], "g1": {"slot": ["v1", "v2"], "other": ["o"], "s": {"x": ["x"]}},
+                            "g2": {"slot": ["w"]}}}
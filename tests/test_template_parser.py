@@ -0,0 +1,56 @@
+import pytest
+
+from wilddivide import wildcards
+
+WILDCARDS = {
+    "hair": ["4, blonde", "5, black", "1, red", "{long|short} hair"],
+    "eyes": ["blue eyes", "green eyes", "{2$$__hair__}", "__color__ eyes"],
+    "color": ["red", "green", "blue", "2, yellow", "30, purple"],
+    "outfit": ["blouse, skirt, __legs__", "shirt, pants, __legs__", "swimsuit, __legs__", "dress {a|b|{c|d}} __legs__"],
+    "legs": ["/skirt/ stockings", "/pants/ socks ! barefoot", "/swimsuit/= sandals", "/dress/=~ heels", "bare feet",
+             "skirt&~pants => knee socks", "pants= => boots", "dress? => slippers", "red|blue => ribbon"],
+    "multi": ["1~3", "a", "b", "c", "d", "5, e"],
+    "few": ["30, maybe", "20, perhaps"],
+    "m/scene": ["__outfit__, __hair__", "{3$$, $$__color__|x|y|z}"],
+    "m/g1/slot": ["v1", "v2"],
+    "m/g2/slot": ["w1", "w2", "__m/g1/*__"],
+    "deep/nested/key": ["deep1", "deep2"],
+    "rec": ["x __rec__", "y"],
+    "neg": ["-1, no", "3, yes"],
+    "empty": [],
+    "nonstr": [None, 5, "ok"],
+}
+
+
+@pytest.fixture(autouse=True)
+def wildcard_dict():
+    wildcards.set_wildcard_dict({k: list(v) for k, v in WILDCARDS.items()})
+
+
+@pytest.mark.parametrize("text", [
+    "__hair__, __eyes__",
+    "{a|b|c} __outfit__ {x|{y|z}} __hair__",
+    "__multi__ and __few__",
+    "__m/scene__ [SEP] __m/g2/slot__",
+    "__*/slot__ __missing__ __hair__",
+    "3#__color__ {2#__color__|q}",
+    "{2-3$$__color__} {1-2$$ and $$a|b|c} {-2$$p|q|r}",
+    "{0.5::a|2::b|c}",
+    "__rec__",
+    "# comment\nline __hair__\n#x\nafter",
+    "__neg__ __empty__ __nonstr__",
+    "{__hair__|__eyes__} __{hair|color}__",
+    "unclosed {a|b {c|d} and } stray",
+    "__Hair__ __HAIR__ __deep/*/key__ __dee*__",
+])
+def test_expander_matches_legacy_rescan_when_exact(text):
+    for seed in range(40):
+        assert wildcards.process(text, seed, legacy=False, exact=True) == wildcards.process(text, seed, legacy=True)
+
+
+def test_expander_keeps_fixed_slot_values():
+    kwargs = {"scene": "fixed scene"}
+    for seed in range(10):
+        expanded = wildcards.process("__m/scene__ __hair__", seed, kwargs, legacy=False, exact=True)
+        assert expanded == wildcards.process("__m/scene__ __hair__", seed, kwargs, legacy=True)
+        assert expanded[0].startswith("fixed scene ")
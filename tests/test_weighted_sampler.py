@@ -0,0 +1,26 @@
+import collections
+import random
+
+import pytest
+
+from wilddivide import wildcards
+
+
+def distribution(choose, samples):
+    counts = collections.Counter(",".join(sorted(choose(random.Random(seed)).split(","))) for seed in range(samples))
+    return {k: v / samples for k, v in counts.items()}
+
+
+@pytest.mark.parametrize("candidates", [
+    ["2~2", "10, a", "20, b", "5, c"],  # written weights sum below 100
+    ["1~3", "30, a", "20, b", "5, c", "d"],
+    ["2~3", "60, a", "50, b", "c"],  # above 100
+])
+def test_alias_sampler_matches_linear_scan(candidates):
+    items = [wildcards.parse_weighted_item(item) for item in candidates]
+    sampler = wildcards.WeightedSampler(items)
+    samples = 20000
+    expected = distribution(lambda rng: wildcards.weighted_random_choice_parsed(items, rng), samples)
+    actual = distribution(sampler.choose, samples)
+    for outcome in set(expected) | set(actual):
+        assert abs(expected.get(outcome, 0.0) - actual.get(outcome, 0.0)) < 0.02, outcome
@@ -0,0 +1,167 @@
+import os
+
+import pytest
+
+from wilddivide import wildcards
+from wilddivide.wildcard_cache import WildcardCache, LazyWildcard, LazyWildcardDict, file_signature
+
+
+def write_file(path, text, mtime_ns):
+    path.write_text(text)
+    os.utime(path, ns=(mtime_ns, mtime_ns))
+    return os.stat(path)
+
+
+def test_cache_round_trip(tmp_path):
+    cache_path = str(tmp_path / "cache.pickle")
+    stat_a = write_file(tmp_path / "a.yaml", "a", 1_000_000_000)
+    stat_b = write_file(tmp_path / "b.yaml", "bb", 2_000_000_000)
+    cache = WildcardCache(cache_path)
+    cache.load()
+    cache.store("a.yaml", stat_a, {"a": ["1"], "a/x": ["2"]})
+    cache.store("b.yaml", stat_b, {"b": ["3"]})
+    cache.save(["a.yaml", "b.yaml"])
+
+    cache = WildcardCache(cache_path)
+    cache.load()
+    assert cache.lookup("a.yaml", stat_a) == ["a", "a/x"]
+    assert cache.read("a.yaml", file_signature(stat_a)) == {"a": ["1"], "a/x": ["2"]}
+    assert cache.read("b.yaml", file_signature(stat_b)) == {"b": ["3"]}
+
+
+def test_changed_file_is_not_taken_from_cache(tmp_path):
+    cache_path = str(tmp_path / "cache.pickle")
+    stat = write_file(tmp_path / "a.yaml", "a", 1_000_000_000)
+    cache = WildcardCache(cache_path)
+    cache.store("a.yaml", stat, {"a": ["1"]})
+    cache.save(["a.yaml"])
+    cache.load()
+
+    touched = write_file(tmp_path / "a.yaml", "a", 3_000_000_000)
+    resized = write_file(tmp_path / "a.yaml", "abc", 1_000_000_000)
+    assert cache.lookup("a.yaml", touched) is None
+    assert cache.lookup("a.yaml", resized) is None
+    assert cache.read("a.yaml", file_signature(touched)) is None
+
+    # a file parsed again replaces its cached version
+    cache.store("a.yaml", resized, {"a": ["new"]})
+    assert cache.read("a.yaml", file_signature(stat)) is None
+    assert cache.read("a.yaml", file_signature(resized)) == {"a": ["new"]}
+
+
+def test_save_keeps_unparsed_files_and_drops_the_others(tmp_path):
+    cache_path = str(tmp_path / "cache.pickle")
+    stat_a = write_file(tmp_path / "a.yaml", "a", 1_000_000_000)
+    stat_b = write_file(tmp_path / "b.yaml", "b", 1_000_000_000)
+    stat_c = write_file(tmp_path / "c.yaml", "c", 1_000_000_000)
+    cache = WildcardCache(cache_path)
+    cache.store("a.yaml", stat_a, {"a": ["1"]})
+    cache.store("b.yaml", stat_b, {"b": ["2"]})
+    cache.save(["a.yaml", "b.yaml"])
+
+    cache = WildcardCache(cache_path)
+    cache.load()
+    cache.store("c.yaml", stat_c, {"c": ["3"]})
+    cache.save(["a.yaml", "c.yaml"])
+
+    cache = WildcardCache(cache_path)
+    cache.load()
+    assert set(cache.files) == {"a.yaml", "c.yaml"}
+    assert cache.read("a.yaml", file_signature(stat_a)) == {"a": ["1"]}
+    assert cache.read("c.yaml", file_signature(stat_c)) == {"c": ["3"]}
+
+    mtime = os.stat(cache_path).st_mtime_ns
+    cache.save(["a.yaml", "c.yaml", "missing.yaml"])
+    assert os.stat(cache_path).st_mtime_ns == mtime
+
+
+def test_unreadable_cache_is_empty(tmp_path, capsys):
+    cache_path = tmp_path / "cache.pickle"
+    cache_path.write_bytes(b"\0\0\0\0\0\0\0\x05junk")
+    cache = WildcardCache(str(cache_path))
+    cache.load()
+    assert cache.files == {}
+    assert "Ignoring unreadable wildcard cache" in capsys.readouterr().out
+    missing = WildcardCache(str(tmp_path / "missing.pickle"))
+    missing.load()
+    assert missing.files == {}
+
+
+def lazy_file(data, loads):
+    def load():
+        loads.append(1)
+        return data
+    return load
+
+
+def test_lazy_dict_loads_all_keys_of_a_file_once():
+    loads = []
+    load = lazy_file({"a": ["1"], "a/b": ["2"]}, loads)
+    d = LazyWildcardDict({"a": LazyWildcard(load, "a"), "a/b": LazyWildcard(load, "a/b"), "c": ["3"]})
+    assert [k for k, _ in d.loaded_items()] == ["c"]
+    assert d["a"] == ["1"]
+    assert d.loaded_items() == [("a", ["1"]), ("a/b", ["2"]), ("c", ["3"])]
+    assert d.get("a/b") == ["2"]
+    assert d.get("missing", []) == []
+    assert len(loads) == 1
+
+
+def test_lazy_dict_copy_and_iteration_keep_placeholders_shared():
+    loads = []
+    load = lazy_file({"a": ["1"], "b": ["2"]}, loads)
+    d = LazyWildcardDict({"a": LazyWildcard(load, "a"), "b": LazyWildcard(load, "b")})
+    copy = d.copy()
+    assert all(isinstance(v, LazyWildcard) for _, v in copy.raw_items())
+    assert copy.items() == [("a", ["1"]), ("b", ["2"])]
+    assert all(isinstance(v, LazyWildcard) for _, v in d.raw_items())
+    assert d.values() == [["1"], ["2"]]
+    assert len(loads) == 2
+
+
+def test_lazy_dict_renamed_key_loads_its_file_key():
+    loads = []
+    load = lazy_file({"m/old": ["1"], "m/other": ["2"]}, loads)
+    d = LazyWildcardDict({"m/new": LazyWildcard(load, "m/old"), "m/other": LazyWildcard(load, "m/other")})
+    assert d["m/new"] == ["1"]
+    assert "m/old" not in d
+    assert d.loaded_items() == [("m/new", ["1"]), ("m/other", ["2"])]
+
+
+@pytest.fixture
+def lazy_wildcards(tmp_path, monkeypatch):
+    user = tmp_path / "user"
+    user.mkdir()
+    default = tmp_path / "default"
+    default.mkdir()
+    monkeypatch.setattr(wildcards, "wildcards_path", str(user))
+    monkeypatch.setattr(wildcards, "default_wildcards_path", str(default))
+    monkeypatch.setattr(wildcards, "WILDCARD_DICT_FILE", str(default / "m.yaml"))
+    monkeypatch.setattr(wildcards, "WILDCARD_CACHE_FILE", str(tmp_path / "cache.pickle"))
+    monkeypatch.setattr(wildcards, "EAGER_WILDCARD_LOAD", False)
+    monkeypatch.setattr(wildcards, "wildcard_cache", None)
+    monkeypatch.setattr(wildcards, "wildcard_journal", None)
+    monkeypatch.setattr(wildcards, "wildcard_menu_history", [])
+    yield user
+    wildcards.flush_wildcard_dict()
+
+
+def test_reload_reads_changed_yaml_and_cache_serves_unchanged(lazy_wildcards, monkeypatch):
+    write_file(lazy_wildcards / "a.yaml", "a:\n  x:\n  - one\n  y:\n  - two\n", 1_000_000_000)
+    write_file(lazy_wildcards / "b.yaml", "b:\n- three\n", 1_000_000_000)
+    wildcards.wildcard_load()
+    assert wildcards.get_wildcard_dict()["a/x"] == ["one"]
+
+    write_file(lazy_wildcards / "a.yaml", "a:\n  x:\n  - changed\n", 2_000_000_000)
+    assert wildcards.wildcard_reload()
+    assert wildcards.get_wildcard_dict()["a/x"] == ["changed"]
+    assert "a/y" not in wildcards.get_wildcard_dict()
+
+    # a restart parses nothing, the values come from the cache when they are used
+    def parse(*args, **kwargs):
+        raise AssertionError("parsed a cached file")
+    monkeypatch.setattr(wildcards, "read_wildcard_yaml", parse)
+    wildcards.wildcard_load()
+    d = wildcards.get_wildcard_dict()
+    assert isinstance(dict.get(d, "b"), LazyWildcard)
+    assert d["a/x"] == ["changed"]
+    assert d["b"] == ["three"]
@@ -1,8 +1,7 @@
 import torch
-import folder_paths
-from nodes import MAX_RESOLUTION, ConditioningCombine, ConditioningSetMask
-from comfy_extras.nodes_mask import MaskComposite, SolidMask
-from .attention_couple import AttentionCoupleWildDivide
+import functools
+from nodes import MAX_RESOLUTION, ConditioningSetMask
+from .attention_couple import AttentionCoupleWildDivide, MaskAtlas
 from . import wildcards
 
 
@@ -26,7 +25,7 @@ class WildcardEncode:
                     {"default": True, "label_on": "Populate", "label_off": "Fixed"},
                 ),
                 "Select to add LoRA": (
-                    ["Select the LoRA to add to the text"] + folder_paths.get_filename_list("loras"),
+                    ["Select the LoRA to add to the text"] + wildcards.get_lora_name_index().names,
                 ),
                 "Select to add Wildcard": (["Select the Wildcard to add to the text"],),
                 "seed": ("INT", {"default": 0, "min": 0, "max": 0xFFFFFFFFFFFFFFFF}),
@@ -70,25 +69,149 @@ class WildcardEncode:
         )
         return model, clip, positives, processed[0]
 
-def calculate_mask_rects(orientation, divisions, width, height):
+def split_lengths(length, weights):
+    """
+    Split length by the weights, the last part takes the remainder.
+    """
+    total = sum(weights)
+    if total <= 0:
+        raise Exception("Split weights should be more than 0")
+    bounds = [length * sum(weights[:i]) // total for i in range(len(weights))] + [length]
+    return [(bounds[i], bounds[i + 1] - bounds[i]) for i in range(len(weights))]
+
+
+def calculate_mask_rects(layout, divisions, width, height):
+    """
+    :param layout: "horizontal", "vertical", ("grid", columns, rows),
+                   ("split", "horizontal" or "vertical", weights) or ("rects", ((x, y, w, h), ...))
+    :return: (x, y, w, h) of each region, grid cells go left to right, then top to bottom
+    """
     mask_rects = []
 
-    if orientation == "horizontal":
+    if layout == "horizontal":
         rect_width = width // divisions
         for i in range(divisions):
             x = i * rect_width
             w = rect_width if i < divisions - 1 else width - x
             mask_rects.append((x, 0, w, height))
-    elif orientation == "vertical":
+    elif layout == "vertical":
         rect_height = height // divisions
         for i in range(divisions):
             y = i * rect_height
             h = rect_height if i < divisions - 1 else height - y
             mask_rects.append((0, y, width, h))
+    elif layout[0] == "grid":
+        columns = calculate_mask_rects("horizontal", layout[1], width, height)
+        rows = calculate_mask_rects("vertical", layout[2], width, height)
+        mask_rects = [(x, y, w, h) for _, y, _, h in rows for x, _, w, _ in columns]
+    elif layout[0] == "split":
+        if layout[1] == "vertical":
+            mask_rects = [(0, y, width, h) for y, h in split_lengths(height, layout[2])]
+        else:
+            mask_rects = [(x, 0, w, height) for x, w in split_lengths(width, layout[2])]
+    elif layout[0] == "rects":
+        mask_rects = list(layout[1])
 
+    if isinstance(layout, tuple) and len(mask_rects) != divisions:
+        raise Exception(f"The layout {layout} has {len(mask_rects)} regions but there are {divisions} divisions")
     return mask_rects
 
 
+def get_layout(options, orientation):
+    """
+    Layout of calculate_mask_rects() from the options of extract_options().
+    """
+    if "rects" in options:
+        return ("rects", tuple(options["rects"]))
+    if "grid" in options:
+        return ("grid",) + options["grid"]
+    if "split" in options:
+        return ("split", orientation, options["split"])
+    return orientation
+
+
+@functools.lru_cache(maxsize=16)
+def build_region_masks(layout, divisions, width, height, overall):
+    """
+    Build the masks of all regions at once.
+
+    Only the CPU masks are cached. Their device copies are kept by the
+    MaskAtlas of each run, so they are freed with the patched model.
+
+    :return: (mask rects, masks [regions, height, width]), the masks are shared
+             by every call with the same arguments and must never be modified
+             in place
+    """
+    mask_rects = calculate_mask_rects(layout, divisions, width, height)
+    if overall:
+        mask_rects.insert(0, (0, 0, width, height))
+
+    rects = torch.tensor(mask_rects, dtype=torch.int64).view(-1, 4, 1, 1)
+    x, y, w, h = rects.unbind(dim=1)
+    xs = torch.arange(width).view(1, 1, -1)
+    ys = torch.arange(height).view(1, -1, 1)
+    masks = ((xs >= x) & (xs < x + w) & (ys >= y) & (ys < y + h)).to(torch.float32)
+    if masks.sum(dim=0).min() == 0:
+        raise Exception(f"The regions of the layout {layout} should cover the whole image, or use overall")
+    return tuple(mask_rects), masks
+
+
+def pad_conditionings(conditionings):
+    """
+    Pad the cond tensors to the longest first cond, repeating their last token, and combine them.
+    The padded tensors are views into one buffer.
+
+    :param conditionings: list of conditionings
+    :return: combined conditioning
+    """
+    max_length = max([conditioning[0][0].shape[1] for conditioning in conditionings])
+    short = [cond[0] for conditioning in conditionings for cond in conditioning if cond[0].shape[1] < max_length]
+    if short:
+        buffer = short[0].new_empty((sum([t.shape[0] for t in short]), max_length, short[0].shape[2]))
+    start = 0
+
+    combined = []
+    for conditioning in conditionings:
+        for cond, extra in conditioning:
+            if cond.shape[1] < max_length:
+                end = start + cond.shape[0]
+                buffer[start:end, :cond.shape[1]] = cond
+                buffer[start:end, cond.shape[1]:] = cond[:, -1:]
+                cond = buffer[start:end]
+                start = end
+            combined.append([cond, extra])
+    return combined
+
+
+def divide_conditionings(model, positives, negative, layout, width, height, overall):
+    """
+    Mask each positive to its region and couple them with attention.
+
+    :return: model, positive, negative
+    """
+    divisions = len(positives)
+    if divisions == 1:
+        overall = False
+    if overall:
+        divisions -= 1
+    if divisions <= 0:
+        raise Exception("Divisions should be more than 0")
+
+    mask_rects, masks = build_region_masks(layout, divisions, width, height, overall)
+    atlas = MaskAtlas(masks)
+
+    for i in range(len(mask_rects)):
+        print(f"mask_rects[{i}]: {mask_rects[i]}")
+
+    conditioning_masks = [
+        ConditioningSetMask().append(positive, atlas.masks[i:i + 1], "default", 1.0)[0]
+        for i, positive in enumerate(positives)
+    ]
+
+    positive_combined = pad_conditionings(conditioning_masks)
+    return AttentionCoupleWildDivide().attention_couple(model, positive_combined, negative, "Attention", atlas)
+
+
 class ComfyDivide:
     @classmethod
     def INPUT_TYPES(cls):
@@ -136,59 +259,9 @@ class ComfyDivide:
         height,
         overall=True,
     ):
-
-        divisions = len(positives)
-        if divisions == 1:
-            overall = False
-        if overall:
-            divisions -= 1
-        if divisions <= 0:
-            raise Exception("Divisions should be more than 0")
-
-        mask_rects = calculate_mask_rects(orientation[0], divisions, width[0], height[0])
-        if overall:
-            mask_rects.insert(0, (0, 0, width[0], height[0]))
-
-        for i in range(len(mask_rects)):
-            print(f"mask_rects[{i}]: {mask_rects[i]}")
-
-        solid_mask_zero = SolidMask().solid(0.0, width[0], height[0])[0]
-        solid_masks = [SolidMask().solid(1.0, rect[2], rect[3])[0] for rect in mask_rects]
-        mask_composites = [
-            MaskComposite().combine(solid_mask_zero, solid_mask, rect[0], rect[1], "add")[0]
-            for rect, solid_mask in zip(mask_rects, solid_masks)
-        ]
-        conditioning_masks = [
-            ConditioningSetMask().append(positive, mask_composite, "default", 1.0)[0]
-            for positive, mask_composite in zip(positives, mask_composites)
-        ]
-
-        # Normalize conditioning tensor lengths before combining
-        all_conditionings = conditioning_masks
-        max_length = max([cond[0][0].shape[1] for cond in all_conditionings])
-        
-        # Pad all conditioning tensors to the same length
-        normalized_conditionings = []
-        for i, conditioning in enumerate(all_conditionings):
-            cond_list = []
-            for j, cond in enumerate(conditioning):
-                current_length = cond[0].shape[1]
-                
-                if current_length < max_length:
-                    pad_length = max_length - current_length
-                    last_token_embedding = cond[0][:, -1:, :]
-                    padding = last_token_embedding.repeat(1, pad_length, 1)
-                    padded_tensor = torch.cat([cond[0], padding], dim=1)
-                    cond_list.append([padded_tensor, cond[1]])
-                else:
-                    cond_list.append(cond)
-            normalized_conditionings.append(cond_list)
-        
-        # Combine normalized conditionings
-        positive_combined = normalized_conditionings[0]
-        for i in range(1, len(normalized_conditionings)):
-            positive_combined = ConditioningCombine().combine(positive_combined, normalized_conditionings[i])[0]
-        return AttentionCoupleWildDivide().attention_couple(model[0], positive_combined, negative[0], "Attention")
+        if isinstance(overall, list):
+            overall = overall[0]
+        return divide_conditionings(model[0], positives, negative[0], orientation[0], width[0], height[0], overall)
 
 
 class WildcardDivide:
@@ -212,7 +285,7 @@ class WildcardDivide:
                     {"default": True, "label_on": "Populate", "label_off": "Fixed"},
                 ),
                 "Select to add LoRA": (
-                    ["Select the LoRA to add to the text"] + folder_paths.get_filename_list("loras"),
+                    ["Select the LoRA to add to the text"] + wildcards.get_lora_name_index().names,
                 ),
                 "Select to add Wildcard": (["Select the Wildcard to add to the text"],),
                 "width": (
@@ -275,75 +348,25 @@ class WildcardDivide:
             orientation = "vertical"
         else:
             orientation = "horizontal"
+        layout = get_layout(options, orientation)
         width = options.get("width", kwargs["width"])
         height = options.get("height", kwargs["height"])
         print(f"width: {width}, height: {height}")
         overall = kwargs["overall"]
-        model, positive, negative = self.process(model, positives, negative, orientation, width, height, overall)
+        model, positive, negative = self.process(model, positives, negative, layout, width, height, overall)
         return model, clip, positive, negative, populated, width, height
 
-    def process(self, model, positives, negative, orientation, width, height, overall):
+    def process(self, model, positives, negative, layout, width, height, overall):
         if model.model.model_type.name == "FLUX":
             return model, positives[0], negative
 
-        divisions = len(positives)
-        if divisions == 1:
-            overall = False
-        if overall:
-            divisions -= 1
-        if divisions <= 0:
-            raise Exception("Divisions should be more than 0")
-
-        mask_rects = calculate_mask_rects(orientation, divisions, width, height)
-        if overall:
-            mask_rects.insert(0, (0, 0, width, height))
-
-        for i in range(len(mask_rects)):
-            print(f"mask_rects[{i}]: {mask_rects[i]}")
-
-        solid_mask_zero = SolidMask().solid(0.0, width, height)[0]
-        solid_masks = [SolidMask().solid(1.0, rect[2], rect[3])[0] for rect in mask_rects]
-        mask_composites = [
-            MaskComposite().combine(solid_mask_zero, solid_mask, rect[0], rect[1], "add")[0]
-            for rect, solid_mask in zip(mask_rects, solid_masks)
-        ]
-        conditioning_masks = [
-            ConditioningSetMask().append(positive, mask_composite, "default", 1.0)[0]
-            for positive, mask_composite in zip(positives, mask_composites)
-        ]
-
-        # Normalize conditioning tensor lengths before combining
-        all_conditionings = conditioning_masks
-        max_length = max([cond[0][0].shape[1] for cond in all_conditionings])
-        
-        # Pad all conditioning tensors to the same length
-        normalized_conditionings = []
-        for i, conditioning in enumerate(all_conditionings):
-            cond_list = []
-            for j, cond in enumerate(conditioning):
-                current_length = cond[0].shape[1]
-                
-                if current_length < max_length:
-                    pad_length = max_length - current_length
-                    last_token_embedding = cond[0][:, -1:, :]
-                    padding = last_token_embedding.repeat(1, pad_length, 1)
-                    padded_tensor = torch.cat([cond[0], padding], dim=1)
-                    cond_list.append([padded_tensor, cond[1]])
-                else:
-                    cond_list.append(cond)
-            normalized_conditionings.append(cond_list)
-        
-        # Combine normalized conditionings
-        positive_combined = normalized_conditionings[0]
-        for i in range(1, len(normalized_conditionings)):
-            positive_combined = ConditioningCombine().combine(positive_combined, normalized_conditionings[i])[0]
-        return AttentionCoupleWildDivide().attention_couple(model, positive_combined, negative, "Attention")
+        return divide_conditionings(model, positives, negative, layout, width, height, overall)
 
 
 
 import threading
 
-threading.Thread(target=wildcards.wildcard_load).start()
+threading.Thread(target=wildcards.wildcard_watch, daemon=True).start()
 
 NODE_CLASS_MAPPINGS = {"WildcardEncode": WildcardEncode, "Comfy Divide": ComfyDivide, "WildcardDivide": WildcardDivide}
 NODE_DISPLAY_NAME_MAPPINGS = {
@@ -0,0 +1,184 @@
+# Persistent cache of parsed wildcard files and lazily loaded wildcard values.
+#
+# Cache file layout:
+#   8 byte big-endian length of the index, the pickled index, then one pickled
+#   {key: values} blob per cached file.
+# The index is {"version": CACHE_VERSION, "files": {path: entry}} and an entry is
+#   {"mtime": st_mtime_ns, "size": st_size, "keys": [...], "offset": int, "length": int}
+# where offset is relative to the end of the index.
+import os
+import pickle
+import struct
+import threading
+
+CACHE_VERSION = 1
+
+
+def file_signature(stat):
+    return stat.st_mtime_ns, stat.st_size
+
+
+class WildcardCache:
+    def __init__(self, path):
+        self.path = path
+        self.files = {}
+        self.data_offset = 0
+        self.parsed = {}  # path -> (signature, {key: values}) parsed since the cache was read
+        self.lock = threading.Lock()
+
+    def load(self):
+        """
+        Read the index of the cache file. A missing or unreadable cache is treated as empty.
+        """
+        with self.lock:
+            self.files = {}
+            self.data_offset = 0
+            try:
+                with open(self.path, "rb") as f:
+                    (index_length,) = struct.unpack(">Q", f.read(8))
+                    index = pickle.loads(f.read(index_length))
+                if index.get("version") == CACHE_VERSION:
+                    self.files = index["files"]
+                    self.data_offset = 8 + index_length
+            except FileNotFoundError:
+                pass
+            except Exception as e:
+                print(f"[WildDivide] Ignoring unreadable wildcard cache '{self.path}'. {e}")
+
+    def lookup(self, file_path, stat):
+        """
+        :return: keys of the cached file, None if it is not cached or has changed
+        """
+        entry = self.files.get(file_path)
+        if entry is None or (entry["mtime"], entry["size"]) != file_signature(stat):
+            return None
+        return entry["keys"]
+
+    def store(self, file_path, stat, data):
+        with self.lock:
+            self.parsed[file_path] = (file_signature(stat), data)
+
+    def read(self, file_path, signature):
+        """
+        :return: {key: values} of a cached file, None if the cache no longer holds that version
+        """
+        with self.lock:
+            if file_path in self.parsed:
+                parsed_signature, data = self.parsed[file_path]
+                return data if parsed_signature == signature else None
+            entry = self.files.get(file_path)
+            if entry is None or (entry["mtime"], entry["size"]) != signature:
+                return None
+            with open(self.path, "rb") as f:
+                f.seek(self.data_offset + entry["offset"])
+                return pickle.loads(f.read(entry["length"]))
+
+    def save(self, file_paths):
+        """
+        Write the cache for the given files, dropping everything else.
+        Only rewritten when something was parsed or removed since it was read.
+        """
+        with self.lock:
+            file_paths = [x for x in file_paths if x in self.parsed or x in self.files]
+            if not self.parsed and set(file_paths) == set(self.files):
+                return
+
+            files = {}
+            blobs = []
+            offset = 0
+            old = open(self.path, "rb") if self.files else None
+            try:
+                for file_path in file_paths:
+                    if file_path in self.parsed:
+                        (mtime, size), data = self.parsed[file_path]
+                        blob = pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL)
+                    else:
+                        entry = self.files[file_path]
+                        mtime, size = entry["mtime"], entry["size"]
+                        old.seek(self.data_offset + entry["offset"])
+                        blob = old.read(entry["length"])
+                        data = None
+                    keys = list(data.keys()) if data is not None else self.files[file_path]["keys"]
+                    files[file_path] = {"mtime": mtime, "size": size, "keys": keys, "offset": offset, "length": len(blob)}
+                    blobs.append(blob)
+                    offset += len(blob)
+            finally:
+                if old is not None:
+                    old.close()
+
+            index = pickle.dumps({"version": CACHE_VERSION, "files": files}, protocol=pickle.HIGHEST_PROTOCOL)
+            temp_path = self.path + ".tmp"
+            with open(temp_path, "wb") as f:
+                f.write(struct.pack(">Q", len(index)))
+                f.write(index)
+                for blob in blobs:
+                    f.write(blob)
+            os.replace(temp_path, self.path)
+
+            self.files = files
+            self.data_offset = 8 + len(index)
+            self.parsed = {}
+
+
+class LazyWildcard:
+    """
+    Placeholder for the values of a key, loaded on first access.
+    The keys of one file share the load callable.
+
+    :param load: callable returning {key: values} of the file
+    :param key: key of the values in the file, which stays the same when the slot is renamed
+    """
+    __slots__ = ("load", "key")
+
+    def __init__(self, load, key):
+        self.load = load
+        self.key = key
+
+
+class LazyWildcardDict(dict):
+    """
+    Wildcard dict whose values may be LazyWildcard placeholders.
+
+    Reading a value through [], get(), items() or values() loads the file
+    behind it and replaces the placeholders of all keys of that file.
+    """
+
+    def resolve(self, key, value):
+        data = value.load()
+        for k, v in data.items():
+            placeholder = dict.get(self, k)
+            if isinstance(placeholder, LazyWildcard) and placeholder.load is value.load and placeholder.key == k:
+                dict.__setitem__(self, k, v)
+        values = data.get(value.key, [])
+        dict.__setitem__(self, key, values)
+        return values
+
+    def __getitem__(self, key):
+        value = dict.__getitem__(self, key)
+        if isinstance(value, LazyWildcard):
+            return self.resolve(key, value)
+        return value
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def items(self):
+        return [(k, self[k]) for k in list(self.keys())]
+
+    def values(self):
+        return [self[k] for k in list(self.keys())]
+
+    def raw_items(self):
+        """Items without loading, values may be LazyWildcard."""
+        return dict.items(self)
+
+    def loaded_items(self):
+        return [(k, v) for k, v in dict.items(self) if not isinstance(v, LazyWildcard)]
+
+    def copy(self):
+        return LazyWildcardDict(dict.items(self))
+
+    def __reduce__(self):
+        return LazyWildcardDict, (self.items(),)
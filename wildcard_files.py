@@ -0,0 +1,72 @@
+# Reading of wildcard files into {key: values}. Used by the worker processes
+# of read_wildcard_files(), so it imports nothing from the rest of the package.
+import time
+import yaml
+
+# libyaml when PyYAML was built with it
+YAML_LOADER = getattr(yaml, "CSafeLoader", yaml.FullLoader)
+
+
+def wildcard_normalize(x):
+    return x.replace("\\", "/").replace(' ', '-').lower()
+
+
+def read_wildcard(k, v, target):
+    if isinstance(v, list):
+        k = wildcard_normalize(k)
+        target[k] = v
+    elif isinstance(v, dict):
+        for k2, v2 in v.items():
+            new_key = f"{k}/{k2}"
+            new_key = wildcard_normalize(new_key)
+            read_wildcard(new_key, v2, target)
+    elif isinstance(v, str):
+        k = wildcard_normalize(k)
+        target[k] = [v]
+
+
+def read_wildcard_txt(key, file_path):
+    """
+    :return: {key: lines of the file without comments}
+    """
+    try:
+        with open(file_path, 'r', encoding="ISO-8859-1") as f:
+            lines = f.read().splitlines()
+    except yaml.reader.ReaderError:
+        with open(file_path, 'r', encoding="UTF-8", errors="ignore") as f:
+            lines = f.read().splitlines()
+    return {key: [x for x in lines if not x.strip().startswith('#')]}
+
+
+def read_wildcard_yaml(file_path):
+    """
+    :return: {normalized key: values} of all keys in the file
+    """
+    with open(file_path, 'rb') as f:
+        content = f.read()
+    try:
+        yaml_data = yaml.load(content.decode("ISO-8859-1"), Loader=YAML_LOADER)
+    except yaml.reader.ReaderError as e:
+        yaml_data = yaml.load(content.decode("UTF-8", errors="ignore"), Loader=YAML_LOADER)
+
+    data = {}
+    for k, v in yaml_data.items():
+        read_wildcard(k, v, data)
+    return data
+
+
+def read_wildcard_file(args):
+    """
+    Read one file in a worker.
+
+    :param args: (key, file_path) of a .txt file or (None, file_path) of a .yaml file
+    :return: ({key: values}, seconds spent, None), or (None, seconds spent, error message)
+             when the file could not be read, such as a half saved .yaml file
+    """
+    key, file_path = args
+    start = time.perf_counter()
+    try:
+        data = read_wildcard_txt(key, file_path) if key is not None else read_wildcard_yaml(file_path)
+    except Exception as e:
+        return None, time.perf_counter() - start, f"{type(e).__name__}: {e}"
+    return data, time.perf_counter() - start, None
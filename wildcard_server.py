@@ -1,3 +1,7 @@
+import asyncio
+import functools
+import hashlib
+import json
 from server import PromptServer
 from . import wildcards
 from . import wild_prompt_generator
@@ -5,28 +9,119 @@ from aiohttp import web
 
 VERSION = "0.6.1"
 
+# route name -> (wildcard dict version, etag, json body), see snapshot_response()
+serialized_snapshots = {}
+
+
+def serialize_snapshot(name, build):
+    version, local_wildcard_dict = wildcards.get_wildcard_snapshot()
+    cached = serialized_snapshots.get(name)
+    if cached is None or cached[0] != version:
+        body = json.dumps({"data": build(local_wildcard_dict)}).encode("utf-8")
+        cached = (version, f'"{hashlib.sha1(body).hexdigest()}"', body)
+        serialized_snapshots[name] = cached
+    return cached
+
+
+async def snapshot_response(request, name, build):
+    """
+    Response with build(wildcard dict) as data, serialized once per wildcard dict version.
+    Answers 304 when the client already has it (If-None-Match).
+    """
+    _, etag, body = await asyncio.get_running_loop().run_in_executor(None, serialize_snapshot, name, build)
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if_none_match = [x.strip().removeprefix("W/") for x in request.headers.get("If-None-Match", "").split(",")]
+    if etag in if_none_match or "*" in if_none_match:
+        return web.Response(status=304, headers=headers)
+    return web.Response(body=body, content_type="application/json", headers=headers)
+
+
 @PromptServer.instance.routes.get("/wilddivide/refresh")
 async def wildcards_refresh(request):
-    wildcards.wildcard_load()
+    await asyncio.get_running_loop().run_in_executor(None, wildcards.wildcard_reload)
     return web.Response(status=200)
 
 
+# query parameters of the listing routes, without them the whole list or dict is returned
+QUERY_PARAMETERS = ("prefix", "filter", "fuzzy", "offset", "limit", "order", "fields")
+
+
+async def query_response(request, fields, format_keys=None):
+    """
+    One page of the wildcards, see wildcards.query_wildcards().
+
+    :param fields: fields returned unless the request asks for others
+    :param format_keys: applied to the page when it is a list of keys
+    """
+    query = request.query
+    try:
+        offset = int(query.get("offset", 0))
+        limit = int(query["limit"]) if "limit" in query else None
+    except ValueError:
+        return web.json_response({"error": "offset and limit should be integers"}, status=400)
+    if offset < 0 or (limit is not None and limit < 0):
+        return web.json_response({"error": "offset and limit should not be negative"}, status=400)
+    order = query.get("order", "dict")
+    fields = query.get("fields", fields)
+    if order not in ("dict", "sorted") or fields not in ("keys", "values", "count"):
+        return web.json_response({"error": "order should be dict or sorted, fields keys, values or count"}, status=400)
+
+    result = await asyncio.get_running_loop().run_in_executor(None, functools.partial(
+        wildcards.query_wildcards,
+        prefix=query.get("prefix", ""),
+        text_filter=query.get("filter", ""),
+        fuzzy=query.get("fuzzy", "false").lower() in ("1", "true"),
+        offset=offset,
+        limit=limit,
+        order=order,
+        fields=fields,
+    ))
+    if format_keys is not None and isinstance(result["data"], list):
+        result["data"] = format_keys(result["data"])
+    return web.json_response(result)
+
+
+@PromptServer.instance.routes.post("/wilddivide/flush")
+async def flush_wildcards(request):
+    await asyncio.get_running_loop().run_in_executor(None, wildcards.flush_wildcard_dict)
+    return web.json_response({"status": "success"})
+
+
+@PromptServer.instance.routes.post("/wilddivide/undo")
+async def undo_edit(request):
+    undone = await asyncio.get_running_loop().run_in_executor(None, wildcards.undo_edit)
+    return web.json_response({"status": "success" if undone else "nothing to undo"})
+
+
 @PromptServer.instance.routes.get("/wilddivide/wildcards/list")
 async def wildcards_list(request):
-    data = {"data": wildcards.get_wildcard_list()}
-    return web.json_response(data)
+    if any(x in request.query for x in QUERY_PARAMETERS):
+        return await query_response(request, "keys", wildcards.get_wildcard_list)
+    return await snapshot_response(request, "list", wildcards.get_wildcard_list)
 
 @PromptServer.instance.routes.get("/wilddivide/wildcards/dict")
 async def wildcards_dict(request):
-    data = {"data": wildcards.get_wildcard_dict()}
-    return web.json_response(data)
+    if any(x in request.query for x in QUERY_PARAMETERS):
+        return await query_response(request, "values")
+    return await snapshot_response(request, "dict", lambda local_wildcard_dict: local_wildcard_dict)
 
 @PromptServer.instance.routes.post("/wilddivide/wildcards")
 async def populate_wildcards(request):
     data = await request.json()
-    populated = wildcards.process(data["text"], data.get("seed", None))
+    loop = asyncio.get_running_loop()
+    populated = await loop.run_in_executor(None, wildcards.process, data["text"], data.get("seed", None))
     return web.json_response({"text": populated})
 
+@PromptServer.instance.routes.post("/wilddivide/wildcards/batch")
+async def populate_wildcards_batch(request):
+    data = await request.json()
+    loop = asyncio.get_running_loop()
+    results = await loop.run_in_executor(None, wildcards.process_batch, data["text"], data["seeds"])
+    return web.json_response({
+        "texts": [text for text, _ in results],
+        "last_generated": [last_generated for _, last_generated in results],
+    })
+
 @PromptServer.instance.routes.post("/wilddivide/add_slot")
 async def add_slot(request):
     data = await request.json()
@@ -87,6 +182,10 @@ async def version(request):
     data = {"version": VERSION}
     return web.json_response(data)
 
+@PromptServer.instance.routes.get("/wilddivide/clip_cache")
+async def clip_cache_stats(request):
+    return web.json_response(wildcards.clip_encode_cache.stats())
+
 def onprompt_populate_wildcards(json_data):
     prompt = json_data["prompt"]
 
@@ -6,84 +6,339 @@ import folder_paths
 import yaml
 import numpy as np
 import threading
-from .pattern_parser import parse_pattern, evaluate_pattern
+import time
+import atexit
+import functools
+import bisect
+import itertools
+import weakref
+import collections
+from .pattern_parser import compile_pattern
+from .template_parser import parse_template, resolve_template, tokenize_wildcards
+from .wildcard_cache import WildcardCache, LazyWildcard, LazyWildcardDict, file_signature
+from .conditioning_cache import ConditioningCache
+from .edit_journal import EditJournal
+from .menu_tree import MenuTree, parent_key
+from .process_pool import worker_pool
+from .wildcard_files import wildcard_normalize, read_wildcard_txt, read_wildcard_yaml, read_wildcard_file
 
 
 wildcards_path = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..", "wildcards"))
 default_wildcards_path = os.path.abspath(os.path.join(os.path.dirname(__file__), "wildcards"))
 WILDCARD_DICT_FILE = os.path.join(default_wildcards_path, "m.yaml")
+# parsed .yaml files, reused across restarts while the files are unchanged
+WILDCARD_CACHE_FILE = os.path.join(os.path.dirname(__file__), "wildcards_cache.pickle")
+# read every wildcard file at startup instead of on first use
+EAGER_WILDCARD_LOAD = False
+# worker processes reading wildcard files, 0 reads them in this process. At most os.cpu_count()
+# are started. Each worker, or the forkserver, first runs the top level of ComfyUI's main.py
+# again, so this pays off only for very large wildcard trees, see process_pool.py.
+WILDCARD_LOAD_WORKERS = 0
+# fewer files than this are read in this process
+WILDCARD_LOAD_POOL_MIN_FILES = 64
+# files which took longer to read are reported by wildcard_load()
+SLOW_WILDCARD_FILE_SECONDS = 0.5
 
 RE_WildCardQuantifier = re.compile(r"(?P<quantifier>\d+)#__(?P<keyword>[\w.\-+/*\\]+?)__", re.IGNORECASE)
+MAX_WILDCARD_EXPANSIONS = 999
+# switch process() back to the rescan-the-whole-string loop
+USE_LEGACY_EXPANDER = False
+# smallest process_batch() which is split across worker processes
+BATCH_POOL_MIN_SIZE = 64
+# worker processes of process_batch(), 0 runs batches in this process. At most os.cpu_count()
+# are started, each runs the top level of ComfyUI's main.py again and imports the nodes module.
+BATCH_POOL_WORKERS = 0
 wildcard_lock = threading.Lock()
-wildcard_dict = {}
+# published wildcard dicts are not modified, edits publish a copy, see publish_wildcard_dict()
+wildcard_dict = LazyWildcardDict()
+# (version, wildcard_dict), replaced as a whole so readers see a matching pair
+wildcard_snapshot = (0, wildcard_dict)
+# MenuTree of the m/ slots. Edits change it, and the next read publishes a wildcard_dict with them
+wildcard_menu = MenuTree()
+# wildcard_menu has edits which are not in wildcard_dict yet, see get_wildcard_dict()
+wildcard_menu_dirty = False
+# key -> (values, CompiledWildcard); see compile_wildcard()
+wildcard_index = {}
+# minimum seconds between fsyncs of the m.yaml journal, 0 fsyncs every edit, None leaves it to the OS
+WILDCARD_FSYNC_INTERVAL = 5
+# journal bytes after which the menu is written to m.yaml and the journal is emptied
+WILDCARD_JOURNAL_COMPACT_SIZE = 1 << 20
+# EditJournal of m.yaml, see get_wildcard_journal()
+wildcard_journal = None
+# ops reverting the last edits of wildcard_menu, the last one is reverted first, see undo_edit()
+wildcard_menu_history = []
+WILDCARD_UNDO_LIMIT = 100
+# WildcardKeyIndex of the last listed wildcard dict, see get_key_index()
+wildcard_key_index = None
+# prefixes whose keys in dict order a WildcardKeyIndex keeps
+KEY_INDEX_PREFIX_CACHE_SIZE = 32
+# WildcardGlobIndex of wildcard_dict, built on the first glob lookup
+wildcard_glob_index = None
+# use the linear scan of weighted_random_choice instead of alias tables,
+# which reproduces the results of seeds from before the alias tables
+EXACT_WEIGHTED_CHOICE = False
+WEIGHTED_SAMPLER_CACHE_SIZE = 1024
+weighted_sampler_cache = collections.OrderedDict()
+weighted_sampler_lock = threading.Lock()
+# file path -> seconds spent reading it during the last wildcard_load()
+wildcard_file_timings = {}
+# seconds between checks of the wildcard files for changes, 0 to disable
+WILDCARD_POLL_INTERVAL = 5
+wildcard_reload_lock = threading.Lock()
+# wildcard directory -> {file path: (signature, [(key, values)])} of the current wildcard dict
+wildcard_files = {}
+# key -> file path its value in the current wildcard dict came from
+wildcard_key_files = {}
+# WildcardCache of the current wildcard dict, False without one, None before the first load
+wildcard_cache = None
+# CLIP text encodings of prompt chunks, see encode_prompt()
+CLIP_CACHE_MB = 1024
+CLIP_CACHE_OFFLOAD = False
+clip_encode_cache = ConditioningCache(CLIP_CACHE_MB, CLIP_CACHE_OFFLOAD)
+# encode the BREAK chunks of all [SEP] regions together, see encode_prompts_batched()
+BATCH_CLIP_ENCODE = False
+# model or clip -> (id of the object the LoRAs were applied to, sorted LoRA specs applied to it)
+patch_lineage = weakref.WeakKeyDictionary()
+patch_lineage_ids = itertools.count()
+# (model base, clip base) -> {(model LoRAs, clip LoRAs) -> (LoRA specs, patched model, patched clip)}
+# holding the chain of patches of the last prompt, see patch_loras()
+lora_patch_cache = {}
+lora_patch_lock = threading.RLock()
+# LoraNameIndex of the loras folders, see get_lora_name_index()
+lora_name_index = None
+
+
+def get_wildcard_list(local_wildcard_dict=None):
+    if local_wildcard_dict is None:
+        local_wildcard_dict = get_wildcard_dict()
+    return [f"__{x}__" for x in local_wildcard_dict]
 
 
-def get_wildcard_list():
-    with wildcard_lock:
-        return [f"__{x}__" for x in wildcard_dict.keys()]
+def get_wildcard_dict():
+    """
+    :return: the current wildcard dict, which must not be modified
+    """
+    if wildcard_menu_dirty:
+        with wildcard_lock:
+            if wildcard_menu_dirty:
+                publish_wildcard_menu()
+    return wildcard_dict
 
 
-def get_wildcard_dict():
-    global wildcard_dict
+def get_wildcard_snapshot():
+    """
+    :return: (version, wildcard dict), the version changes whenever a new dict is published
+    """
+    get_wildcard_dict()
+    return wildcard_snapshot
+
+
+def publish_wildcard_dict(new_dict, menu=None):
+    """
+    Make new_dict the current wildcard dict. Call with wildcard_lock held.
+    Readers use the dict without locking, so it must not be modified afterwards,
+    except for LazyWildcardDict loading its values.
+
+    :param menu: MenuTree of the m/ slots of new_dict, built from it if not given
+    """
+    global wildcard_dict, wildcard_snapshot, wildcard_menu, wildcard_menu_dirty
+    if menu is None:
+        menu = MenuTree.from_items((k, v) for k, v in raw_items(new_dict) if k.startswith("m/"))
+    wildcard_snapshot = (wildcard_snapshot[0] + 1, new_dict)
+    wildcard_dict = new_dict
+    wildcard_menu = menu
+    wildcard_menu_dirty = False
+
+
+def publish_wildcard_menu():
+    """
+    Publish a wildcard dict with the m/ slots of the edited wildcard_menu. Call with wildcard_lock held.
+    """
+    publish_wildcard_dict(with_menu(wildcard_dict, wildcard_menu), wildcard_menu)
+
+
+def with_menu(local_wildcard_dict, menu):
+    """
+    :return: LazyWildcardDict of local_wildcard_dict with the m/ slots of menu,
+             which take the place of its first m/ key
+    """
+    new_dict = LazyWildcardDict()
+    menu_added = False
+    for k, v in raw_items(local_wildcard_dict):
+        if not k.startswith("m/"):
+            dict.__setitem__(new_dict, k, v)
+        elif not menu_added:
+            dict.update(new_dict, menu.items())
+            menu_added = True
+    if not menu_added:
+        dict.update(new_dict, menu.items())
+    return new_dict
+
+
+def menu_edited(added=(), removed=(), renamed=(), undo=False):
+    """
+    Call with wildcard_lock held after editing wildcard_menu, see update_wildcard_index() for the parameters.
+    The flat wildcard dict is rebuilt on the next read, and the edit is saved to the m.yaml journal.
+
+    :param undo: the edit reverted the last edit of wildcard_menu_history
+    """
+    global wildcard_menu_dirty
+    wildcard_menu_dirty = True
+    update_wildcard_index(added, removed, renamed)
+    save_wildcard_dict(undo)
+
+
+def apply_menu_ops(menu, ops):
+    """
+    Apply ops of MenuTree.take_ops() to menu. Ops which do not apply any more,
+    because m.yaml was changed by hand, are skipped.
+
+    :return: number of skipped ops
+    """
+    skipped = 0
+    for op in ops:
+        try:
+            menu.apply(op)
+        except Exception:
+            skipped += 1
+    return skipped
+
+
+def undo_edit():
+    """
+    Revert the last edit of the m/ slots.
+
+    :return: False if there was nothing to revert
+    """
     with wildcard_lock:
-        return wildcard_dict
+        get_wildcard_journal()
+        if not wildcard_menu_history:
+            return False
+        skipped = apply_menu_ops(wildcard_menu, wildcard_menu_history.pop())
+        if skipped:
+            print(f"[WildDivide] Skipped {skipped} changes of the undo which do not apply any more.")
+        removed = [k for k in wildcard_index if k.startswith("m/") and k not in wildcard_menu]
+        menu_edited(removed=removed, undo=True)
+        return True
 
 
 def set_wildcard_dict(dict):
-    global wildcard_dict
     with wildcard_lock:
-        wildcard_dict = dict
+        publish_wildcard_dict(dict)
+        rebuild_wildcard_index()
 
 
-def wildcard_normalize(x):
-    return x.replace("\\", "/").replace(' ', '-').lower()
+def read_wildcard_files(tasks):
+    """
+    Read files with read_wildcard_file(), in WILDCARD_LOAD_WORKERS worker processes when there are many.
 
+    :return: results in the order of tasks
+    """
+    workers = min(WILDCARD_LOAD_WORKERS, os.cpu_count() or 1)
+    if workers > 1 and len(tasks) >= WILDCARD_LOAD_POOL_MIN_FILES:
+        chunk_size = max(1, len(tasks) // (workers * 4))
+        # the workers import only wildcard_files.py
+        with worker_pool(workers) as executor:
+            return list(executor.map(read_wildcard_file, tasks, chunksize=chunk_size))
+    return [read_wildcard_file(task) for task in tasks]
 
-def read_wildcard(k, v):
-    if isinstance(v, list):
-        k = wildcard_normalize(k)
-        wildcard_dict[k] = v
-    elif isinstance(v, dict):
-        for k2, v2 in v.items():
-            new_key = f"{k}/{k2}"
-            new_key = wildcard_normalize(new_key)
-            read_wildcard(new_key, v2)
-    elif isinstance(v, str):
-        k = wildcard_normalize(k)
-        wildcard_dict[k] = [v]
 
+def read_cached_wildcard_yaml(cache, file_path, signature):
+    data = cache.read(file_path, signature)
+    if data is None:
+        # the cache was rewritten since the file was indexed
+        data = read_wildcard_yaml(file_path)
+    return data
 
-def read_wildcard_dict(wildcard_path):
-    global wildcard_dict
+
+def read_wildcard_dict(wildcard_path, cache=None, previous=None, fallback=None):
+    """
+    Read the wildcard files under wildcard_path.
+
+    With a cache, values are LazyWildcard placeholders which are read on first
+    use. .txt files are read from the file itself, .yaml files from the cache,
+    which has to be parsed again only when the file changed.
+
+    Files which have to be read now are read in parallel. The time spent on
+    each is recorded in wildcard_file_timings.
+
+    :param cache: WildcardCache, None to read every file now
+    :param previous: result of the last call for the same path, whose records
+                     are reused for files with the same mtime and size
+    :param fallback: records kept for files which cannot be read, defaults to previous
+    :return: {file path: (signature, [(key, values)])} in the order of the directory walk
+    """
+    if previous is None:
+        previous = {}
+    if fallback is None:
+        fallback = previous
+    records = {}
+    tasks = []
+    stats = {}
     for root, directories, files in os.walk(wildcard_path, followlinks=True):
         for file in files:
+            if not file.endswith('.txt') and not file.endswith('.yaml'):
+                continue
+            file_path = os.path.join(root, file)
+            try:
+                stat = os.stat(file_path)
+            except OSError as e:
+                # removed while walking
+                print(f"[WildDivide] Failed to read wildcard file '{file_path}'. {e}")
+                continue
+            signature = file_signature(stat)
+            if previous.get(file_path, (None,))[0] == signature:
+                records[file_path] = previous[file_path]
+                continue
+
             if file.endswith('.txt'):
-                file_path = os.path.join(root, file)
                 rel_path = os.path.relpath(file_path, wildcard_path)
                 key = wildcard_normalize(os.path.splitext(rel_path)[0])
 
-                try:
-                    with open(file_path, 'r', encoding="ISO-8859-1") as f:
-                        lines = f.read().splitlines()
-                        wildcard_dict[key] = [x for x in lines if not x.strip().startswith('#')]
-                except yaml.reader.ReaderError:
-                    with open(file_path, 'r', encoding="UTF-8", errors="ignore") as f:
-                        lines = f.read().splitlines()
-                        wildcard_dict[key] = [x for x in lines if not x.strip().startswith('#')]
-            elif file.endswith('.yaml'):
-                file_path = os.path.join(root, file)
+                if cache is None:
+                    tasks.append((key, file_path))
+                    records[file_path] = signature
+                else:
+                    load = functools.partial(read_wildcard_txt, key, file_path)
+                    records[file_path] = (signature, [(key, LazyWildcard(load, key))])
+            else:
+                if cache is not None:
+                    keys = cache.lookup(file_path, stat)
+                    if keys is not None:
+                        load = functools.partial(read_cached_wildcard_yaml, cache, file_path, signature)
+                        records[file_path] = (signature, [(k, LazyWildcard(load, k)) for k in keys])
+                        continue
+                    stats[file_path] = stat
+                tasks.append((None, file_path))
+                records[file_path] = signature
+
+    for (_, file_path), (data, seconds, error) in zip(tasks, read_wildcard_files(tasks)):
+        wildcard_file_timings[file_path] = seconds
+        if error is not None:
+            if file_path in fallback:
+                print(f"[WildDivide] Failed to read wildcard file '{file_path}', keeping its last values. {error}")
+                records[file_path] = fallback[file_path]
+            else:
+                print(f"[WildDivide] Failed to read wildcard file '{file_path}', skipping it. {error}")
+                del records[file_path]
+            continue
+        if file_path in stats:
+            cache.store(file_path, stats[file_path], data)
+        records[file_path] = (records[file_path], list(data.items()))
 
-                try:
-                    with open(file_path, 'r', encoding="ISO-8859-1") as f:
-                        yaml_data = yaml.load(f, Loader=yaml.FullLoader)
-                except yaml.reader.ReaderError as e:
-                    with open(file_path, 'r', encoding="UTF-8", errors="ignore") as f:
-                        yaml_data = yaml.load(f, Loader=yaml.FullLoader)
+    return records
 
-                for k, v in yaml_data.items():
-                    read_wildcard(k, v)
 
-    return wildcard_dict
+def report_wildcard_file_timings():
+    if not wildcard_file_timings:
+        return
+    total = sum(wildcard_file_timings.values())
+    print(f"[WildDivide] Read {len(wildcard_file_timings)} wildcard files in {total:.2f}s of worker time.")
+    slow_files = sorted(wildcard_file_timings.items(), key=lambda x: x[1], reverse=True)
+    for file_path, seconds in slow_files:
+        if seconds < SLOW_WILDCARD_FILE_SECONDS:
+            break
+        print(f"[WildDivide] Slow wildcard file ({seconds:.2f}s): {file_path}")
 
 
 def process_comment_out(text):
@@ -107,42 +362,36 @@ def process_comment_out(text):
     return '\n'.join(lines0)
 
 
-def weighted_random_choice(items):
-    weighted_items = []
-    total_weight = 0.0
-    num_choices = 1
-    start_index = 0
+def parse_weighted_item(item):
+    """
+    Pre-parse a candidate line for weighted_random_choice.
 
-    if len(items) > 0:
-        r = re.match(r"^ *([0-9]+)~([0-9]+) *$", items[0])
-        if r is not None:
-            num_choices = random.randint(int(r.group(1)), int(r.group(2)))
-            start_index = 1
+    :param item: candidate text such as "4, blonde", "1~3" or "red"
+    :return: (prob, content, choice_range, item) - prob is None when no weight is written
+    """
+    r = re.match(r"^ *([0-9]+)~([0-9]+) *$", item)
+    choice_range = (int(r.group(1)), int(r.group(2))) if r is not None else None
 
-    total_prob = 0.0
-    written_items = []
-    unwritten_items = []
-    for item in items[start_index:]:
-        parts = item.split(",", 1)  # split on first comma
-        if len(parts) > 1 and is_numeric_string(parts[0].strip()):
-            prob = float(parts[0].strip())
-            total_prob += prob
-            written_items.append((prob, parts[1].strip()))
-        else:
-            unwritten_items.append(item)
+    parts = item.split(",", 1)  # split on first comma
+    if len(parts) > 1 and is_numeric_string(parts[0].strip()):
+        return float(parts[0].strip()), parts[1].strip(), choice_range, item
+    return None, item, choice_range, item
 
-    if total_prob > 100.0:
-        weighted_items = written_items
-        total_weight = total_prob
-    else:
-        rest_prob = (100.0 - total_prob) / len(unwritten_items) if unwritten_items else 0.0
-        weighted_items = written_items + [(rest_prob, item) for item in unwritten_items]
-        total_weight = 100.0
+
+def weighted_random_choice(items, rng=random):
+    return weighted_random_choice_parsed([parse_weighted_item(item) for item in items], rng)
+
+
+def weighted_random_choice_parsed(items, rng=random):
+    choice_range, weighted_items, total_weight = weighted_items_of(items)
+    num_choices = 1
+    if choice_range is not None:
+        num_choices = rng.randint(choice_range[0], choice_range[1])
 
     choices = []
     available_items = weighted_items.copy()
     for _ in range(min(num_choices, len(weighted_items))):
-        r = random.uniform(0.0, total_weight)
+        r = rng.uniform(0.0, total_weight)
         current_weight = 0.0
 
         for i, (weight, content) in enumerate(available_items):
@@ -160,186 +409,863 @@ def weighted_random_choice(items):
     return ",".join(choices)
 
 
-def process(text, seed=None, kwargs=None):
-    text = process_comment_out(text)
+def weighted_items_of(items):
+    """
+    Weights of pre-parsed candidates as weighted_random_choice_parsed assigns them.
+
+    :return: (choice_range, [(weight, content)], total_weight)
+    """
+    choice_range = None
+    start_index = 0
+    if len(items) > 0 and items[0][2] is not None:
+        choice_range = items[0][2]
+        start_index = 1
 
-    if seed is not None:
-        random.seed(seed)
-    random_gen = np.random.default_rng(seed)
+    total_prob = 0.0
+    written_items = []
+    unwritten_items = []
+    for prob, content, _, item in items[start_index:]:
+        if prob is not None:
+            total_prob += prob
+            written_items.append((prob, content))
+        else:
+            unwritten_items.append(item)
+
+    if total_prob > 100.0:
+        return choice_range, written_items, total_prob
+    rest_prob = (100.0 - total_prob) / len(unwritten_items) if unwritten_items else 0.0
+    return choice_range, written_items + [(rest_prob, item) for item in unwritten_items], 100.0
+
+
+class WeightedSampler:
+    """
+    Walker/Vose alias table over pre-parsed candidates.
 
+    Draws from the same distribution as weighted_random_choice_parsed with one
+    random number per pick. Picks after the first one are sampled without
+    replacement by rejecting already chosen items, and fall back to the linear
+    scan once most of the weight has been chosen.
+    """
+
+    def __init__(self, items):
+        self.choice_range, self.weighted_items, total_weight = weighted_items_of(items)
+        weights = [weight for weight, _ in self.weighted_items]
+        self.total = sum(weights)
+        # written weights below 100 without unwritten items leave a chance to choose nothing
+        slack = total_weight - self.total
+        if slack > total_weight * 1e-9:
+            weights.append(slack)
+        self.valid = self.total > 0.0 and all(weight >= 0.0 for weight in weights)
+        if self.valid:
+            self.prob, self.alias = build_alias_table(weights)
+
+    def draw(self, rng):
+        # index into weighted_items, len(weighted_items) is the "nothing" slot
+        x = rng.random() * len(self.prob)
+        i = int(x)
+        if i >= len(self.prob):
+            i = len(self.prob) - 1
+        return i if x - i < self.prob[i] else self.alias[i]
+
+    def choose(self, rng=random):
+        if not self.valid:
+            return None
+        num_choices = 1
+        if self.choice_range is not None:
+            num_choices = rng.randint(self.choice_range[0], self.choice_range[1])
+        count = min(num_choices, len(self.weighted_items))
+        if count <= 0:
+            return ""
+
+        i = self.draw(rng)
+        if count == 1:
+            return self.weighted_items[i][1] if i < len(self.weighted_items) else ""
+
+        chosen = []
+        picked = set()
+        remaining_weight = self.total
+        if i < len(self.weighted_items):
+            chosen.append(i)
+            picked.add(i)
+            remaining_weight -= self.weighted_items[i][0]
+        else:
+            # like the linear scan, a first draw past the written weights uses up a pick,
+            # the later picks choose among the items only
+            count -= 1
+        while len(chosen) < count and remaining_weight > self.total * 0.5:
+            i = self.draw(rng)
+            if i < len(self.weighted_items) and i not in picked:
+                chosen.append(i)
+                picked.add(i)
+                remaining_weight -= self.weighted_items[i][0]
+
+        choices = [self.weighted_items[i][1] for i in chosen]
+        if len(chosen) < count:
+            available_items = [item for i, item in enumerate(self.weighted_items) if i not in picked]
+            total_weight = sum(weight for weight, _ in available_items)
+            for _ in range(count - len(chosen)):
+                r = rng.uniform(0.0, total_weight)
+                current_weight = 0.0
+
+                for i, (weight, content) in enumerate(available_items):
+                    current_weight += weight
+                    if r <= current_weight:
+                        choices.append(content)
+                        available_items.pop(i)
+                        break
+
+                total_weight = sum(weight for weight, _ in available_items)
+
+        if len(choices) == 0:
+            choices = [""]
+        return ",".join(choices)
+
+
+def build_alias_table(weights):
+    n = len(weights)
+    total = sum(weights)
+    scaled = [weight * n / total for weight in weights]
+    prob = [1.0] * n
+    alias = list(range(n))
+    small = [i for i, p in enumerate(scaled) if p < 1.0]
+    large = [i for i, p in enumerate(scaled) if p >= 1.0]
+    while small and large:
+        s = small.pop()
+        l = large.pop()
+        prob[s] = scaled[s]
+        alias[s] = l
+        scaled[l] = scaled[l] + scaled[s] - 1.0
+        if scaled[l] < 1.0:
+            small.append(l)
+        else:
+            large.append(l)
+    return prob, alias
+
+
+def get_weighted_sampler(items):
+    """
+    Return the cached WeightedSampler of a candidate list, keyed by the candidates.
+    """
+    key = tuple(items)
+    with weighted_sampler_lock:
+        sampler = weighted_sampler_cache.get(key)
+        if sampler is not None:
+            weighted_sampler_cache.move_to_end(key)
+            return sampler
+    sampler = WeightedSampler(items)
+    with weighted_sampler_lock:
+        weighted_sampler_cache[key] = sampler
+        if len(weighted_sampler_cache) > WEIGHTED_SAMPLER_CACHE_SIZE:
+            weighted_sampler_cache.popitem(last=False)
+    return sampler
+
+
+def weighted_choice(items, sampler=None, exact=False, rng=random):
+    """
+    Choose from pre-parsed candidates.
+
+    :param items: parse_weighted_item() results
+    :param sampler: WeightedSampler of items if it is already known
+    :param exact: use the linear scan of weighted_random_choice_parsed
+    :param rng: random.Random to draw from
+    """
+    if not exact:
+        if sampler is None:
+            sampler = get_weighted_sampler(items)
+        choice = sampler.choose(rng)
+        if choice is not None:
+            return choice
+    return weighted_random_choice_parsed(items, rng)
+
+
+class CompiledWildcard:
+    """
+    Compiled entries of a wildcard.
+
+    candidates is set when no entry has a condition, the candidate list is the
+    same for every prefix then and its sampler is built once.
+    """
+
+    def __init__(self, entries):
+        self.entries = entries
+        self.conditional = any(entry.type != "PLAIN" for entry in entries)
+        self.candidates = None if self.conditional else [entry.match for entry in entries]
+        self._sampler = None
+
+    @property
+    def sampler(self):
+        if self._sampler is None and self.candidates is not None:
+            self._sampler = WeightedSampler(self.candidates)
+        return self._sampler
+
+    @staticmethod
+    def merge(compiled_wildcards):
+        return CompiledWildcard([entry for compiled in compiled_wildcards for entry in compiled.entries])
+
+
+class WildcardEntry:
+    """
+    Pre-parsed wildcard line.
+
+    type is one of:
+        "PLAIN": always a candidate
+        "REGEX": '/pattern/replacement' line, condition is a compiled regex
+        "PATTERN": 'pattern => replacement' line, condition is a compile_pattern() predicate
+        "ERROR": malformed line, error is raised when the line is evaluated
+    match and not_match are parse_weighted_item() results.
+    """
+    __slots__ = ("type", "condition", "match", "not_match", "exclusive", "exclusive_else", "error")
+
+    def __init__(self, type, condition=None, match=None, not_match=None, exclusive=False, exclusive_else=False, error=None):
+        self.type = type
+        self.condition = condition
+        self.match = match
+        self.not_match = not_match
+        self.exclusive = exclusive
+        self.exclusive_else = exclusive_else
+        self.error = error
+
+
+@functools.lru_cache(maxsize=4096)
+def compile_regex(pattern):
+    return re.compile(pattern, re.IGNORECASE)
+
+
+def compile_wildcard_entry(item):
+    if item is None or not isinstance(item, str):
+        return WildcardEntry("PLAIN", match=parse_weighted_item(""))
+    try:
+        if item.startswith("/"):
+            pattern, replacement = item[1:].split("/", 1)
+            exclusive = False
+            exclusive_else = False
+            if replacement.startswith("="):
+                replacement = replacement[1:]
+                exclusive = True
+                if replacement.startswith("~"):
+                    replacement = replacement[1:]
+                    exclusive_else = True
+
+            replacement = replacement.strip()
+            if "!" in replacement:
+                match, not_match = replacement.split("!", 1)
+                not_match = parse_weighted_item(not_match)
+            else:
+                match = replacement
+                not_match = None
+
+            return WildcardEntry("REGEX", compile_regex(pattern), parse_weighted_item(match), not_match,
+                                 exclusive, exclusive_else)
+        elif "=>" in item:
+            pattern, replacement = item.split("=>", 1)
+            pattern = pattern.strip()
+            if len(pattern) == 0:
+                return None
+            exclusive = False
+            exclusive_else = False
+            if pattern.endswith('='):
+                pattern = pattern[:-1]
+                exclusive = True
+            if pattern.endswith('?'):
+                pattern = pattern[:-1]
+                exclusive_else = True
+            replacement = replacement.strip()
+            return WildcardEntry("PATTERN", compile_pattern(pattern), parse_weighted_item(replacement), None,
+                                 exclusive, exclusive_else)
+    except Exception as e:
+        return WildcardEntry("ERROR", error=e)
+    return WildcardEntry("PLAIN", match=parse_weighted_item(item))
+
+
+def compile_wildcard_entries(items):
+    entries = [compile_wildcard_entry(item) for item in items]
+    return [entry for entry in entries if entry is not None]
+
+
+def compile_wildcard(key, values):
+    """
+    Return the compiled wildcard, compiling it if the index is stale.
+
+    :param key: normalized wildcard key
+    :param values: current value list of the key
+    :return: CompiledWildcard
+    """
+    cached = wildcard_index.get(key)
+    if cached is not None and cached[0] is values:
+        return cached[1]
+    compiled = CompiledWildcard(compile_wildcard_entries(values))
+    wildcard_index[key] = (values, compiled)
+    return compiled
+
+
+def rebuild_wildcard_index():
+    """
+    Bring the compiled index up to date with wildcard_dict. Only keys whose value list
+    was replaced or removed are dropped or compiled again, the values of unchanged files
+    are the same lists. Keys which are not loaded yet are compiled on first use.
+    """
+    invalidate_glob_index()
+    values = dict(raw_items(wildcard_dict))
+    for k in [k for k, cached in wildcard_index.items() if values.get(k) is not cached[0]]:
+        del wildcard_index[k]
+    for k, v in values.items():
+        if not isinstance(v, LazyWildcard):
+            compile_wildcard(k, v)
+
+
+def update_wildcard_index(added=(), removed=(), renamed=()):
+    """
+    Incrementally update the compiled index after an edit of wildcard_menu.
+
+    :param added: keys whose values were added or changed
+    :param removed: keys which no longer exist
+    :param renamed: (old_key, new_key) pairs whose values were kept
+    """
+    invalidate_glob_index()
+    for k in removed:
+        wildcard_index.pop(k, None)
+    for old_k, new_k in renamed:
+        compiled = wildcard_index.pop(old_k, None)
+        if compiled is not None:
+            wildcard_index[new_k] = compiled
+    for k in added:
+        values = wildcard_menu.get(k)
+        if isinstance(values, list):
+            compile_wildcard(k, values)
+
+
+class WildcardGlobIndex:
+    """
+    Key index of one wildcard dict for glob keywords (with '*').
+
+    A glob keyword matches a key when its regex (see glob_regex()) matches at
+    the start of the key or of the key + '/'. Candidates are looked up by the
+    literal text the glob starts with, or for globs starting with '*' by the
+    literal text after it when that starts at a '/'. Globs which have neither
+    scan all keys. The candidates are checked with the regex and the merged
+    result is kept per glob.
+    """
+
+    def __init__(self, local_wildcard_dict):
+        self.wildcard_dict = local_wildcard_dict
+        self.keys = list(local_wildcard_dict.keys())
+        self.positions = {k: i for i, k in enumerate(self.keys)}
+        self.sorted_keys = sorted(self.keys)
+        # (text from a '/' of key + '/' to the end, key)
+        self.segments = sorted((f"{k}/"[i:], k) for k in self.keys for i in find_all(f"{k}/", "/"))
+        self.merged = {}
+
+    def find(self, keyword):
+        """
+        :return: merged CompiledWildcard of the keys matching the glob keyword, None if none match
+        """
+        if keyword not in self.merged:
+            keys = self.match(keyword)
+            self.merged[keyword] = CompiledWildcard.merge(
+                [compile_wildcard(k, self.wildcard_dict[k]) for k in keys]) if keys else None
+        return self.merged[keyword]
+
+    def match(self, keyword):
+        """
+        :return: keys matching the glob keyword in dict order
+        """
+        regex = glob_regex(keyword)
+        head = RE_GlobLiteral.match(keyword).group()
+        if head:
+            candidates = self.with_prefix(self.sorted_keys, head, lambda x: x)
+            if head.endswith('/') and head[:-1] in self.positions:
+                candidates.append(head[:-1])
+        else:
+            literal = RE_GlobLiteral.match(keyword.lstrip("*.")).group()
+            if not literal.startswith('/'):
+                candidates = self.keys
+            else:
+                candidates = set(self.with_prefix(self.segments, (literal,), lambda x: x[1]))
+                candidates = sorted(candidates, key=self.positions.get)
+
+        keys = [k for k in candidates if regex.match(k) is not None or regex.match(k + '/') is not None]
+        if head:
+            keys = sorted(set(keys), key=self.positions.get)
+        return keys
+
+    @staticmethod
+    def with_prefix(sorted_items, prefix, get_key):
+        """
+        :return: keys of the items which start with prefix, items are str or (str, key)
+        """
+        start = bisect.bisect_left(sorted_items, prefix)
+        text = prefix if isinstance(prefix, str) else prefix[0]
+        result = []
+        for i in range(start, len(sorted_items)):
+            item = sorted_items[i]
+            if not (item if isinstance(item, str) else item[0]).startswith(text):
+                break
+            result.append(get_key(item))
+        return result
+
+
+# literal text before the first '*' or '.', which are wildcards in glob keywords
+RE_GlobLiteral = re.compile(r"[^*.]*")
+
+
+@functools.lru_cache(maxsize=4096)
+def glob_regex(keyword):
+    return re.compile(keyword.replace('*', '.*').replace('+', '\\+'))
+
+
+def find_all(text, sub):
+    i = text.find(sub)
+    while i != -1:
+        yield i
+        i = text.find(sub, i + 1)
+
+
+def get_glob_index(local_wildcard_dict):
+    """
+    :return: WildcardGlobIndex of the dict, kept until the next reload or edit for the loaded dict
+    """
+    global wildcard_glob_index
+    index = wildcard_glob_index
+    if index is not None and index.wildcard_dict is local_wildcard_dict:
+        return index
+    index = WildcardGlobIndex(local_wildcard_dict)
+    if local_wildcard_dict is wildcard_dict:
+        wildcard_glob_index = index
+    return index
+
+
+def invalidate_glob_index():
+    global wildcard_glob_index
+    wildcard_glob_index = None
+
+
+class WildcardKeyIndex:
+    """
+    Sorted keys of one wildcard dict for the paginated listing routes.
+
+    Prefixes are looked up with bisect. For listing in dict order, the keys of
+    the dict and the keys with each requested prefix are kept in dict order,
+    so a page without a text filter is a slice.
+
+    :param previous: WildcardKeyIndex of an earlier dict, whose sorted keys are reused
+    """
+
+    def __init__(self, local_wildcard_dict, previous=None):
+        self.wildcard_dict = local_wildcard_dict
+        if previous is None:
+            self.sorted_keys = sorted(local_wildcard_dict.keys())
+        else:
+            kept = [k for k in previous.sorted_keys if k in local_wildcard_dict]
+            added = sorted(k for k in local_wildcard_dict.keys() if k not in previous.wildcard_dict)
+            # two sorted runs, which sorted() merges in linear time
+            self.sorted_keys = sorted(kept + added)
+        self.keys = None  # keys in dict order
+        self.positions = None  # key -> position in self.keys
+        self.prefix_keys = collections.OrderedDict()  # prefix -> keys with it in dict order
+        self.lock = threading.Lock()
+
+    def prefix_range(self, prefix):
+        if not prefix:
+            return 0, len(self.sorted_keys)
+        start = bisect.bisect_left(self.sorted_keys, prefix)
+        end = bisect.bisect_left(self.sorted_keys, prefix[:-1] + chr(ord(prefix[-1]) + 1), start)
+        return start, end
+
+    def query(self, prefix="", text_filter="", fuzzy=False, offset=0, limit=None, order="dict"):
+        """
+        :param text_filter: keep keys containing it, or with fuzzy the keys containing its characters in order
+        :param order: "dict" or "sorted"
+        :return: (keys of the page, number of matching keys or None when filtered, offset of the next page or None)
+        """
+        start, end = self.prefix_range(prefix)
+        if order == "sorted":
+            keys = self.sorted_keys
+        elif prefix:
+            keys = self.get_prefix_keys(prefix, start, end)
+            start, end = 0, len(keys)
+        else:
+            keys = self.get_keys()
+
+        total = end - start
+        stop = None if limit is None else offset + limit + 1
+        if text_filter:
+            text_filter = text_filter.lower()
+            if fuzzy:
+                matches = (k for k in itertools.islice(keys, start, end) if fuzzy_match(text_filter, k))
+            else:
+                matches = (k for k in itertools.islice(keys, start, end) if text_filter in k)
+            page = list(itertools.islice(matches, offset, stop))
+            total = None
+        else:
+            page = keys[start + offset:end if stop is None else min(end, start + stop)]
+        next_offset = None
+        if limit is not None and len(page) > limit:
+            page = page[:limit]
+            next_offset = offset + limit
+        return page, total, next_offset
+
+
+    def get_keys(self):
+        if self.keys is None:
+            self.keys = list(self.wildcard_dict.keys())
+        return self.keys
+
+    def get_prefix_keys(self, prefix, start, end):
+        """
+        :return: keys with the prefix in dict order, sorted on the first request for the prefix
+        """
+        with self.lock:
+            keys = self.prefix_keys.get(prefix)
+            if keys is not None:
+                self.prefix_keys.move_to_end(prefix)
+                return keys
+        positions = self.get_positions()
+        keys = sorted(self.sorted_keys[start:end], key=positions.get)
+        with self.lock:
+            self.prefix_keys[prefix] = keys
+            if len(self.prefix_keys) > KEY_INDEX_PREFIX_CACHE_SIZE:
+                self.prefix_keys.popitem(last=False)
+        return keys
+
+    def get_positions(self):
+        if self.positions is None:
+            self.positions = {k: i for i, k in enumerate(self.get_keys())}
+        return self.positions
+
+
+def fuzzy_match(pattern, text):
+    """
+    :return: True if the characters of pattern appear in text in order
+    """
+    it = iter(text)
+    return all(c in it for c in pattern)
+
+
+def get_key_index(local_wildcard_dict):
+    """
+    :return: WildcardKeyIndex of the dict, derived from the index of the previously listed dict
+    """
+    global wildcard_key_index
+    index = wildcard_key_index
+    if index is not None and index.wildcard_dict is local_wildcard_dict:
+        return index
+    index = WildcardKeyIndex(local_wildcard_dict, index)
+    wildcard_key_index = index
+    return index
+
+
+def query_wildcards(prefix="", text_filter="", fuzzy=False, offset=0, limit=None, order="dict", fields="keys"):
+    """
+    One page of the current wildcard dict, see WildcardKeyIndex.query().
+
+    :param fields: "keys" for a list of keys, "values" for {key: values}, "count" for {key: number of values}
+    :return: {"data": page, "total": int or None, "next_offset": int or None}
+    """
     local_wildcard_dict = get_wildcard_dict()
-    last_generated = {}
+    keys, total, next_offset = get_key_index(local_wildcard_dict).query(prefix, text_filter, fuzzy, offset, limit, order)
+    if fields == "values":
+        data = {k: local_wildcard_dict[k] for k in keys}
+    elif fields == "count":
+        data = {k: len(local_wildcard_dict[k]) for k in keys}
+    else:
+        data = keys
+    return {"data": data, "total": total, "next_offset": next_offset}
 
-    def replace_options(string):
-        replacements_found = False
 
-        def replace_option(match):
-            nonlocal replacements_found
-            options = match.group(1).split('|')
-
-            multi_select_pattern = options[0].split('$$')
-            select_range = None
-            select_sep = ' '
-            range_pattern = r'(\d+)(-(\d+))?'
-            range_pattern2 = r'-(\d+)'
-            wildcard_pattern = r"__([\w.\-+/*\\]+?)__"
-
-            if len(multi_select_pattern) > 1:
-                r = re.match(range_pattern, options[0])
-
-                if r is None:
-                    r = re.match(range_pattern2, options[0])
-                    a = '1'
-                    b = r.group(1).strip()
+def raw_items(d):
+    """
+    Items of a wildcard dict without loading its LazyWildcard values.
+    """
+    if isinstance(d, LazyWildcardDict):
+        return d.raw_items()
+    return d.items()
+
+
+def select_candidates(entries, prefix):
+    """
+    Evaluate the conditions of compiled entries against the preceding prompt.
+    Each distinct condition is evaluated once.
+
+    :return: (candidates, exclusive_candidates)
+    """
+    candidates = []
+    exclusive_candidates = []
+    results = {}
+    for entry in entries:
+        if entry.type == "PLAIN":
+            candidates.append(entry.match)
+            continue
+        if entry.type == "ERROR":
+            raise entry.error
+
+        matched = results.get(entry.condition)
+        if matched is None:
+            if entry.type == "REGEX":
+                matched = entry.condition.search(prefix) is not None
+            else:
+                matched = entry.condition(prefix)
+            results[entry.condition] = matched
+
+        if entry.type == "REGEX":
+            if matched:
+                if entry.exclusive:
+                    exclusive_candidates.append(entry.match)
                 else:
-                    a = r.group(1).strip()
-                    b = r.group(3)
-                    if b is not None:
-                        b = b.strip()
-                        
-                if r is not None:
-                    if b is not None and is_numeric_string(a) and is_numeric_string(b):
-                        # PATTERN: num1-num2
-                        select_range = int(a), int(b)
-                    elif is_numeric_string(a):
-                        # PATTERN: num
-                        x = int(a)
-                        select_range = (x, x)
-
-                    if select_range is not None and len(multi_select_pattern) == 2:
-                        # PATTERN: count$$
-                        matches = re.findall(wildcard_pattern, multi_select_pattern[1])
-                        if len(options) == 1 and matches:
-                            # count$$<single wildcard>
-                            options = local_wildcard_dict.get(matches[0])
-                        else:
-                            # count$$opt1|opt2|...
-                            options[0] = multi_select_pattern[1]
-                    elif select_range is not None and len(multi_select_pattern) == 3:
-                        # PATTERN: count$$ sep $$
-                        select_sep = multi_select_pattern[1]
-                        options[0] = multi_select_pattern[2]
-
-            adjusted_probabilities = []
-
-            total_prob = 0
-
-            for option in options:
-                parts = option.split('::', 1)
-                if len(parts) == 2 and is_numeric_string(parts[0].strip()):
-                    config_value = float(parts[0].strip())
+                    candidates.append(entry.match)
+            else:
+                if entry.exclusive_else:
+                    candidates.append(entry.match)
+                elif entry.not_match is not None:
+                    if entry.exclusive:
+                        exclusive_candidates.append(entry.not_match)
+                    else:
+                        candidates.append(entry.not_match)
+        else:
+            if matched:
+                if entry.exclusive or entry.exclusive_else:
+                    exclusive_candidates.append(entry.match)
                 else:
-                    config_value = 1  # Default value if no configuration is provided
+                    candidates.append(entry.match)
+            elif entry.exclusive_else:
+                candidates.append(entry.match)
+    return candidates, exclusive_candidates
+
+
+def expand_quantifiers(text):
+    """
+    Rewrite 'N#__keyword__' into 'N' copies of '__keyword__' separated by '|'.
+    """
+    option_quantifier = [e.groupdict() for e in RE_WildCardQuantifier.finditer(text)]
+    for match in option_quantifier:
+        keyword = match['keyword'].lower()
+        quantifier = int(match['quantifier']) if match['quantifier'] else 1
+        replacement = '__|__'.join([keyword,] * quantifier)
+        wilder_keyword = keyword.replace('*', '\\*')
+        RE_TEMP = re.compile(fr"(?P<quantifier>\d+)#__(?P<keyword>{wilder_keyword})__", re.IGNORECASE)
+        text = RE_TEMP.sub(f"__{replacement}__", text)
+    return text
+
+
+@functools.lru_cache(maxsize=16384)
+def compile_template(text):
+    """
+    Apply quantifiers and parse a template or wildcard value. Cached by text.
+
+    :return: (Template, legacy_text) - option groups which pull values from a
+             wildcard ('count$$__name__') may inject new groups, legacy_text is
+             set for them and is resolved by the legacy substitution loop
+    """
+    if '#' in text:
+        text = expand_quantifiers(text)
+    if '{' in text and '$$' in text and '__' in text:
+        return None, text
+    return parse_template(text), None
+
+
+def process(text, seed=None, kwargs=None, legacy=None, exact=None):
+    """
+    Populate wildcards and options in text.
+
+    :param text: wildcard text
+    :param seed: seed for populating
+    :param kwargs: fixed values of 'm/' slots, "disabled" or "random"
+    :param legacy: use the legacy rescan loop instead of the single pass expander,
+                   defaults to USE_LEGACY_EXPANDER. With exact=True both produce the same
+                   result for a seed, otherwise the expander draws weighted candidates
+                   from the same distribution but not the same picks.
+    :param exact: choose weighted candidates with the linear scan instead of alias tables
+                  to reproduce results of older versions, defaults to EXACT_WEIGHTED_CHOICE.
+                  Always on for the legacy loop.
+    :return: (populated text, {keyword: generated value})
+    """
+    return populate(process_comment_out(text), seed, kwargs, legacy, exact)
+
+
+def process_batch(text, seeds, kwargs=None, legacy=None, exact=None):
+    """
+    Populate one wildcard text for many seeds.
 
-                adjusted_probabilities.append(config_value)
-                total_prob += config_value
+    The text is prepared once and every seed sees the same wildcard dict.
+    The results are the same as calling process() for each seed.
+
+    :param text: wildcard text
+    :param seeds: list of seeds, split across BATCH_POOL_WORKERS worker processes
+                  when there are at least BATCH_POOL_MIN_SIZE
+    :return: list of (populated text, {keyword: generated value}) in the order of seeds
+    """
+    text = process_comment_out(text)
+    seeds = list(seeds)
+    local_wildcard_dict = get_wildcard_dict()
+
+    workers = min(BATCH_POOL_WORKERS, os.cpu_count() or 1)
+    if workers > 1 and len(seeds) >= BATCH_POOL_MIN_SIZE:
+        chunk_size = -(-len(seeds) // workers)
+        chunks = [seeds[i:i + chunk_size] for i in range(0, len(seeds), chunk_size)]
+        with worker_pool(workers, init_batch_worker, (local_wildcard_dict,)) as executor:
+            results = executor.map(process_batch_chunk, [(text, chunk, kwargs, legacy, exact) for chunk in chunks])
+            return [result for chunk_results in results for result in chunk_results]
+
+    return [populate(text, seed, kwargs, legacy, exact, local_wildcard_dict) for seed in seeds]
+
+
+def init_batch_worker(local_wildcard_dict):
+    global wildcard_dict
+    wildcard_dict = local_wildcard_dict
+    rebuild_wildcard_index()
 
-            normalized_probabilities = [prob / total_prob for prob in adjusted_probabilities]
 
-            if select_range is None:
-                select_count = 1
+def process_batch_chunk(args):
+    text, seeds, kwargs, legacy, exact = args
+    local_wildcard_dict = get_wildcard_dict()
+    return [populate(text, seed, kwargs, legacy, exact, local_wildcard_dict) for seed in seeds]
+
+
+class WildcardContext:
+    """
+    State of one expansion: its random generators, the wildcard dict snapshot it
+    reads and the values it generated. Expansions with their own context do not
+    share state, so they can run concurrently.
+
+    random draws the wildcard choices, random_gen the {a|b} options. Their
+    sequences for a seed are the same as the global random seeded by process()
+    used to produce.
+    """
+
+    def __init__(self, seed=None, kwargs=None, local_wildcard_dict=None, exact=False):
+        self.random = random.Random(seed)
+        self.random_gen = np.random.default_rng(seed)
+        self.kwargs = kwargs
+        self.wildcard_dict = get_wildcard_dict() if local_wildcard_dict is None else local_wildcard_dict
+        self.exact = exact
+        self.last_generated = {}
+        self.glob_index = None
+
+    def choose_option(self, body):
+        options = body.split('|')
+
+        multi_select_pattern = options[0].split('$$')
+        select_range = None
+        select_sep = ' '
+        range_pattern = r'(\d+)(-(\d+))?'
+        range_pattern2 = r'-(\d+)'
+        wildcard_pattern = r"__([\w.\-+/*\\]+?)__"
+
+        if len(multi_select_pattern) > 1:
+            r = re.match(range_pattern, options[0])
+
+            if r is None:
+                r = re.match(range_pattern2, options[0])
+                a = '1'
+                b = r.group(1).strip()
             else:
-                select_count = random_gen.integers(low=select_range[0], high=select_range[1]+1, size=1)
+                a = r.group(1).strip()
+                b = r.group(3)
+                if b is not None:
+                    b = b.strip()
+
+            if r is not None:
+                if b is not None and is_numeric_string(a) and is_numeric_string(b):
+                    # PATTERN: num1-num2
+                    select_range = int(a), int(b)
+                elif is_numeric_string(a):
+                    # PATTERN: num
+                    x = int(a)
+                    select_range = (x, x)
+
+                if select_range is not None and len(multi_select_pattern) == 2:
+                    # PATTERN: count$$
+                    matches = re.findall(wildcard_pattern, multi_select_pattern[1])
+                    if len(options) == 1 and matches:
+                        # count$$<single wildcard>
+                        options = list(self.wildcard_dict.get(matches[0]))
+                    else:
+                        # count$$opt1|opt2|...
+                        options[0] = multi_select_pattern[1]
+                elif select_range is not None and len(multi_select_pattern) == 3:
+                    # PATTERN: count$$ sep $$
+                    select_sep = multi_select_pattern[1]
+                    options[0] = multi_select_pattern[2]
+
+        adjusted_probabilities = []
 
-            if select_count > len(options):
-                random_gen.shuffle(options)
-                selected_items = options
+        total_prob = 0
+
+        for option in options:
+            parts = option.split('::', 1)
+            if len(parts) == 2 and is_numeric_string(parts[0].strip()):
+                config_value = float(parts[0].strip())
             else:
-                selected_items = random_gen.choice(options, p=normalized_probabilities, size=select_count, replace=False)
+                config_value = 1  # Default value if no configuration is provided
+
+            adjusted_probabilities.append(config_value)
+            total_prob += config_value
+
+        normalized_probabilities = [prob / total_prob for prob in adjusted_probabilities]
 
-            selected_items2 = [re.sub(r'^\s*[0-9.]+::', '', x, 1) for x in selected_items]
-            replacement = select_sep.join(selected_items2)
-            if '::' in replacement:
-                pass
+        if select_range is None:
+            select_count = 1
+        else:
+            select_count = self.random_gen.integers(low=select_range[0], high=select_range[1]+1, size=1)
+
+        if select_count > len(options):
+            self.random_gen.shuffle(options)
+            selected_items = options
+        else:
+            selected_items = self.random_gen.choice(options, p=normalized_probabilities, size=select_count, replace=False)
+
+        selected_items2 = [re.sub(r'^\s*[0-9.]+::', '', x, 1) for x in selected_items]
+        replacement = select_sep.join(selected_items2)
+        if '::' in replacement:
+            pass
+
+        return replacement
+
+    def replace_options(self, string):
+        replacements_found = False
 
+        def replace_option(match):
+            nonlocal replacements_found
             replacements_found = True
-            return replacement
+            return self.choose_option(match.group(1))
 
         pattern = r'{([^{}]*?)}'
         replaced_string = re.sub(pattern, replace_option, string)
 
         return replaced_string, replacements_found
 
-    def regexp_or_weighted_choice(items, prefix, keyword):
-        if kwargs is not None and keyword in kwargs:
-            if kwargs[keyword] == "disabled":
+    def regexp_or_weighted_choice(self, compiled, prefix, keyword):
+        if self.kwargs is not None and keyword in self.kwargs:
+            if self.kwargs[keyword] == "disabled":
                 return ""
-            elif kwargs[keyword] != "random":
-                last_generated[keyword] = kwargs[keyword]
-                return kwargs[keyword]
-        candidates = []
-        exclusive_candidates = []
-        for item in items:
-            if item is None or not isinstance(item, str):
-                candidates.append("")
-            elif item.startswith("/"):
-                pattern, replacement = item[1:].split("/", 1)
-                if replacement is None:
-                    replacement = ""
-                exclusive = False
-                exclusive_else = False
-                if replacement.startswith("="):
-                    replacement = replacement[1:]
-                    exclusive = True
-                    if replacement.startswith("~"):
-                        replacement = replacement[1:]
-                        exclusive_else = True
-
-                replacement = replacement.strip()
-                if "!" in replacement:
-                    match, not_match = replacement.split("!", 1)
-                else:
-                    match = replacement
-                    not_match = None
-
-                if re.search(pattern, prefix, re.IGNORECASE):
-                    if exclusive:
-                        exclusive_candidates.append(match)
-                    else:
-                        candidates.append(match)
-                else:
-                    if exclusive_else:
-                        candidates.append(match)
-                    else:
-                        if not_match is not None:
-                            if exclusive:
-                                exclusive_candidates.append(not_match)
-                            else:
-                                candidates.append(not_match)
-            elif "=>" in item:
-                pattern, replacement = item.split("=>", 1)
-                pattern = pattern.strip()
-                if len(pattern) > 0:
-                    exclusive = False
-                    exclusive_else = False
-                    if pattern.endswith('='):
-                        pattern = pattern[:-1]
-                        exclusive = True
-                    if pattern.endswith('?'):
-                        pattern = pattern[:-1]
-                        exclusive_else = True
-                    replacement = replacement.strip()
-                    pattern_tree = parse_pattern(pattern)
-                    if evaluate_pattern(pattern_tree, prefix):
-                        if exclusive or exclusive_else:
-                            exclusive_candidates.append(replacement)
-                        else:
-                            candidates.append(replacement)
-                    else:
-                        if exclusive_else:
-                            candidates.append(replacement)
-            else:
-                candidates.append(item)
+            elif self.kwargs[keyword] != "random":
+                self.last_generated[keyword] = self.kwargs[keyword]
+                return self.kwargs[keyword]
+        if not compiled.conditional:
+            if len(compiled.candidates) == 0:
+                self.last_generated[keyword] = ""
+                return ""
+            self.last_generated[keyword] = weighted_choice(compiled.candidates, None if self.exact else compiled.sampler, self.exact, self.random)
+            return self.last_generated[keyword]
+        candidates, exclusive_candidates = select_candidates(compiled.entries, prefix)
         if len(exclusive_candidates) > 0:
-            last_generated[keyword] = weighted_random_choice(exclusive_candidates)
-            return last_generated[keyword]
+            self.last_generated[keyword] = weighted_choice(exclusive_candidates, exact=self.exact, rng=self.random)
+            return self.last_generated[keyword]
         if len(candidates) == 0:
-            last_generated[keyword] = ""
+            self.last_generated[keyword] = ""
             return ""
-        last_generated[keyword] = weighted_random_choice(candidates)
-        return last_generated[keyword]
-
-    def replace_wildcard(string):
+        self.last_generated[keyword] = weighted_choice(candidates, exact=self.exact, rng=self.random)
+        return self.last_generated[keyword]
+
+    def find_wildcard(self, keyword):
+        if keyword in self.wildcard_dict:
+            return compile_wildcard(keyword, self.wildcard_dict[keyword])
+        elif '*' in keyword:
+            if self.glob_index is None:
+                self.glob_index = get_glob_index(self.wildcard_dict)
+            return self.glob_index.find(keyword)
+        return None
+
+    def replace_wildcard(self, string):
         pattern = r"__([\w.\-+/*\\]+?)__"
         match = re.search(pattern, string)
 
@@ -349,100 +1275,125 @@ def process(text, seed=None, kwargs=None):
             match_str = match.group(1)
             keyword = match_str.lower()
             keyword = wildcard_normalize(keyword)
-            if keyword in local_wildcard_dict:
-                replacement = regexp_or_weighted_choice(local_wildcard_dict[keyword], string[:match.start()], keyword[2:])
+            compiled = self.find_wildcard(keyword)
+            if compiled is not None:
+                replacement = self.regexp_or_weighted_choice(compiled, string[:match.start()], keyword[2:])
                 replacements_found = True
                 string = string.replace(f"__{match_str}__", replacement, 1)
-            elif '*' in keyword:
-                subpattern = keyword.replace('*', '.*').replace('+', '\\+')
-                total_patterns = []
-                found = False
-                for k, v in local_wildcard_dict.items():
-                    if re.match(subpattern, k) is not None or re.match(subpattern, k+'/') is not None:
-                        total_patterns += v
-                        found = True
-
-                if found:
-                    replacement = regexp_or_weighted_choice(total_patterns, string[:match.start()], keyword[2:])
-                    replacements_found = True
-                    string = string.replace(f"__{match_str}__", replacement, 1)
-            elif '/' not in keyword:
+            elif '*' not in keyword and '/' not in keyword:
                 string_fallback = string.replace(f"__{match_str}__", f"__*/{match_str}__", 1)
-                string, replacements_found = replace_wildcard(string_fallback)
+                string, replacements_found = self.replace_wildcard(string_fallback)
 
         return string, replacements_found
 
-    replace_depth = 1000
-    stop_unwrap = False
-    while not stop_unwrap and replace_depth > 1:
-        replace_depth -= 1  # prevent infinite loop
-        
-        option_quantifier = [e.groupdict() for e in RE_WildCardQuantifier.finditer(text)]
-        for match in option_quantifier:
-            keyword = match['keyword'].lower()
-            quantifier = int(match['quantifier']) if match['quantifier'] else 1
-            replacement = '__|__'.join([keyword,] * quantifier)
-            wilder_keyword = keyword.replace('*', '\\*')
-            RE_TEMP = re.compile(fr"(?P<quantifier>\d+)#__(?P<keyword>{wilder_keyword})__", re.IGNORECASE)
-            text = RE_TEMP.sub(f"__{replacement}__", text)
+    def resolve(self, text):
+        template, legacy_text = compile_template(text)
+        if legacy_text is not None:
+            resolved, is_replaced = self.replace_options(legacy_text)
+            while is_replaced:
+                resolved, is_replaced = self.replace_options(resolved)
+            return tokenize_wildcards(resolved)
+        if template.tokens is not None:
+            return template.tokens
+        return tokenize_wildcards(resolve_template(template, self.choose_option))
+
+    def expand(self, text):
+        # Depth-first expansion into a list buffer. A wildcard sees the text
+        # generated so far as its prefix, and its value is resolved right
+        # after it is chosen, which is the order of the legacy rescan loop.
+        out = []
+        stack = [(self.resolve(text), 0)]
+        expansions = 0
+        halted = False
+        while stack:
+            tokens, i = stack.pop()
+            while i < len(tokens):
+                kind, value = tokens[i]
+                i += 1
+                if kind == "TEXT":
+                    out.append(value)
+                    continue
+                if halted:
+                    out.append(f"__{value}__")
+                    continue
+
+                keyword = wildcard_normalize(value.lower())
+                compiled = self.find_wildcard(keyword)
+                if compiled is None and '*' not in keyword and '/' not in keyword:
+                    # retry as __*/name__, rescanning the rest like the legacy loop does
+                    rest = "".join(v if k == "TEXT" else f"__{v}__" for k, v in tokens[i:])
+                    tokens = tokenize_wildcards(f"__*/{value}__{rest}")
+                    i = 0
+                    continue
+                if compiled is None:
+                    # unknown wildcard stops the expansion
+                    out.append(f"__{value}__")
+                    halted = True
+                    continue
+
+                prefix = "".join(out) if compiled.conditional else ""
+                replacement = self.regexp_or_weighted_choice(compiled, prefix, keyword[2:])
+                expansions += 1
+                if expansions >= MAX_WILDCARD_EXPANSIONS:
+                    out.append(replacement)
+                    halted = True
+                    continue
+                stack.append((tokens, i))
+                stack.append((self.resolve(replacement), 0))
+                break
+        return "".join(out)
+
+    def expand_legacy(self, text):
+        replace_depth = MAX_WILDCARD_EXPANSIONS + 1
+        stop_unwrap = False
+        while not stop_unwrap and replace_depth > 1:
+            replace_depth -= 1  # prevent infinite loop
+
+            text = expand_quantifiers(text)
+
+            # pass1: replace options
+            pass1, is_replaced1 = self.replace_options(text)
+
+            while is_replaced1:
+                pass1, is_replaced1 = self.replace_options(pass1)
 
-        # pass1: replace options
-        pass1, is_replaced1 = replace_options(text)
+            # pass2: replace wildcards
+            text, is_replaced2 = self.replace_wildcard(pass1)
+            stop_unwrap = not is_replaced1 and not is_replaced2
+
+        return text
 
-        while is_replaced1:
-            pass1, is_replaced1 = replace_options(pass1)
 
-        # pass2: replace wildcards
-        text, is_replaced2 = replace_wildcard(pass1)
-        stop_unwrap = not is_replaced1 and not is_replaced2
+def populate(text, seed=None, kwargs=None, legacy=None, exact=None, local_wildcard_dict=None):
+    """
+    process() for text which has already been passed through process_comment_out().
+
+    :param local_wildcard_dict: wildcard dict to populate from, defaults to the loaded one
+    """
+    if legacy is None:
+        legacy = USE_LEGACY_EXPANDER
+    if exact is None:
+        exact = EXACT_WEIGHTED_CHOICE or legacy
+
+    context = WildcardContext(seed, kwargs, local_wildcard_dict, exact)
+    if legacy:
+        return context.expand_legacy(text), context.last_generated
+    return context.expand(text), context.last_generated
 
-    return text, last_generated
 
 def add_slot(name, values):
     if not name or not name.strip():
         return
 
-    global wildcard_dict
     with wildcard_lock:
         slot_name = f"m/{wildcard_normalize(name.strip())}"
         values = [v.strip() for v in values.removeprefix("- ").split("\n- ")]
 
-        # If slot already exists, just update values
-        if slot_name in wildcard_dict:
-            wildcard_dict[slot_name] = values
-            save_wildcard_dict(wildcard_dict)
-            return
-
-        # Get group name (everything before the last '/')
-        group_name = remove_last_key(slot_name)
-        
-        new_dict = {}
-        last_group_key = None
-        
-        # Find the last key of the target group
-        for k in wildcard_dict.keys():
-            curr_group = remove_last_key(k)
-            if curr_group == group_name:
-                last_group_key = k
-            elif group_name == "m" and curr_group == "m" and "/" not in k[2:]:
-                # For root level slots
-                last_group_key = k
-
-        # Add slots in the correct order
-        for k, v in wildcard_dict.items():
-            new_dict[k] = v
-            if k == last_group_key:
-                new_dict[slot_name] = values
-
-        # If we haven't added the new slot yet (no matching group found)
-        if slot_name not in new_dict:
-            new_dict[slot_name] = values
-
-        wildcard_dict = new_dict
-        save_wildcard_dict(new_dict)
+        # An existing slot gets the values, a new one goes after the last slot of its group
+        wildcard_menu.add(slot_name, values)
+        menu_edited(added=[slot_name])
 
 def rename_slot(name, new_name):
-    global wildcard_dict
     with wildcard_lock:
         name = name.strip()
         new_name = new_name.strip()
@@ -452,20 +1403,14 @@ def rename_slot(name, new_name):
         new_name = wildcard_normalize(new_name)
         name = f"m/{name}"
         new_name = f"m/{new_name}"
-        new_dict = {}
-        for k, v in wildcard_dict.items():
-            if k == name:
-                new_dict[new_name] = v
-            else:
-                new_dict[k] = v
-        wildcard_dict = new_dict
-        save_wildcard_dict(new_dict)
+        if name not in wildcard_menu:
+            return
+        menu_edited(renamed=wildcard_menu.rename(name, new_name))
 
 def remove_last_key(key):
     return '/'.join(key.split('/')[:-1])
 
 def edit_group(name, new_name):
-    global wildcard_dict
     with wildcard_lock:
         name = name.strip()
         new_name = new_name.strip()
@@ -475,57 +1420,48 @@ def edit_group(name, new_name):
         new_name = wildcard_normalize(new_name)
         name = f"m/{name}"
         new_name = f"m/{new_name}"
-        new_dict = {}
-        for k, v in wildcard_dict.items():
-            if k.startswith(name):
-                new_key = k.replace(name, new_name)
-                new_dict[new_key] = v
-            else:
-                new_dict[k] = v
-        wildcard_dict = new_dict
-        save_wildcard_dict(new_dict)
+        if name not in wildcard_menu.groups:
+            return
+        menu_edited(renamed=wildcard_menu.rename(name, new_name, is_group=True))
 
 def delete_group(name):
-    local_wildcard_dict = get_wildcard_dict()
     name = name.strip()
     if name == "":
         return
     name = wildcard_normalize(name)
     name = f"m/{name}"
-    for k in list(local_wildcard_dict.keys()):
-        if k.startswith(name):
-            del local_wildcard_dict[k]
-    save_wildcard_dict(local_wildcard_dict)
+    with wildcard_lock:
+        if name not in wildcard_menu.groups:
+            return
+        menu_edited(removed=wildcard_menu.remove(name, is_group=True))
 
 def delete_slot(name):
-    local_wildcard_dict = get_wildcard_dict()
     name = name.strip()
     if name == "":
         return
     name = wildcard_normalize(name)
     name = f"m/{name}"
-    del local_wildcard_dict[name]
-    save_wildcard_dict(local_wildcard_dict)
+    with wildcard_lock:
+        if name not in wildcard_menu:
+            raise KeyError(name)
+        menu_edited(removed=wildcard_menu.remove(name))
 
-# move from_key before to_key
+# move from_key before to_key, or to the front of its group if to_key is the group
 def reorder_slot(from_key, to_key):
-    global wildcard_dict
-    new_dict = {}
-    for k, v in wildcard_dict.items():
-        if k == to_key:
-            new_dict[from_key] = wildcard_dict[from_key]
-        if k != from_key:
-            new_dict[k] = v
-    wildcard_dict = new_dict
-    save_wildcard_dict(new_dict)
+    if to_key in wildcard_menu:
+        wildcard_menu.move(from_key, before=to_key)
+    elif to_key == parent_key(from_key):
+        wildcard_menu.move(from_key)
+    else:
+        return
+    menu_edited()
 
 def move_slot(from_key, to_key, is_target_group=False, is_copy=False, force=False):
     """Move or copy a slot from one group to another or to/from root"""
-    global wildcard_dict
     with wildcard_lock:
         from_key = f"m/{from_key}"
         to_key = f"m/{to_key}"
-        if from_key not in wildcard_dict:
+        if from_key not in wildcard_menu:
             return
         
         # Get target group and slot name
@@ -542,114 +1478,131 @@ def move_slot(from_key, to_key, is_target_group=False, is_copy=False, force=Fals
         new_key = f"{to_group}/{from_name}"
         
         # Check if the target key already exists
-        if not force and new_key in wildcard_dict:
+        if not force and new_key in wildcard_menu:
             return {"status": "conflict", "key": new_key.replace("m/", "")}
         
         # Get the slot value
-        slot_value = wildcard_dict[from_key]
+        slot_value = wildcard_menu.get(from_key)
         
         # Remove from the original location if not copying
         if not is_copy:
-            del wildcard_dict[from_key]
+            wildcard_menu.remove(from_key)
         
         # Add to the new location
-        new_dict = {}
         if is_target_group:
-            # If target is a group widget, find the first slot of that group
-            first_slot = next((k for k, v in wildcard_dict.items() if k.startswith(f"{to_group}/")), None)
-            if first_slot is not None:
-                # Add before the first slot of the group
-                for k, v in wildcard_dict.items():
-                    if k == first_slot:
-                        new_dict[new_key] = slot_value
-                    new_dict[k] = v
-            else:
-                # If group is empty, just add the slot
-                new_dict[new_key] = slot_value
-                new_dict.update(wildcard_dict)
+            # If target is a group widget, add it before the first slot of that group
+            is_new_group = to_group not in wildcard_menu.groups
+            wildcard_menu.add(new_key, slot_value)
+            wildcard_menu.move(new_key)
+            if is_new_group:
+                wildcard_menu.move(to_group, is_group=True)
         else:
-            # Normal slot movement - add after the target slot
-            for k, v in wildcard_dict.items():
-                if k == to_key:
-                    new_dict[new_key] = slot_value
-                    if new_key != k:
-                        new_dict[k] = v
-                else:
-                    new_dict[k] = v
+            # Normal slot movement - add before the target slot
+            if new_key != to_key and new_key in wildcard_menu:
+                wildcard_menu.remove(new_key)
+            before = to_key if new_key != to_key and to_key in wildcard_menu else None
+            wildcard_menu.add(new_key, slot_value, before=before)
                     
-        wildcard_dict = new_dict
-        save_wildcard_dict(wildcard_dict)
-
-def save_wildcard_dict(wildcard_dict):
-    m_wildcard_dict = {k: v for k, v in wildcard_dict.items() if k.startswith("m/")}
-    m_wildcard_dict_new = {}
-    for k, v in m_wildcard_dict.items():
-        if "/" in k:
-            keys = k.split("/")
-            if keys[0] not in m_wildcard_dict_new:
-                m_wildcard_dict_new[keys[0]] = {}
-            if len(keys) == 2:
-                m_wildcard_dict_new[keys[0]][keys[1]] = v
-            elif len(keys) == 3:
-                if keys[1] not in m_wildcard_dict_new[keys[0]]:
-                    m_wildcard_dict_new[keys[0]][keys[1]] = {}
-                m_wildcard_dict_new[keys[0]][keys[1]][keys[2]] = v
+        if is_copy:
+            menu_edited(added=[new_key])
         else:
-            m_wildcard_dict_new[k] = v
+            menu_edited(renamed=[(from_key, new_key)])
+
+def save_wildcard_dict(undo=False):
+    """
+    Append the edits of wildcard_menu since the last save to the m.yaml journal, which is
+    written in the background and compacted into m.yaml when it grows, see EditJournal.
+    Call with wildcard_lock held.
+
+    :param undo: the edits reverted the last edit of wildcard_menu_history
+    """
+    ops, undo_ops = wildcard_menu.take_ops()
+    if not ops:
+        return
+    journal = get_wildcard_journal()
+    if undo:
+        journal.append({"ops": ops, "undone": True})
+    else:
+        journal.append({"ops": ops, "undo": undo_ops})
+        push_menu_history(undo_ops)
+
+
+def push_menu_history(undo_ops):
+    wildcard_menu_history.append(undo_ops)
+    if len(wildcard_menu_history) > WILDCARD_UNDO_LIMIT:
+        del wildcard_menu_history[0]
+
+
+def get_wildcard_journal():
+    """
+    The journal of WILDCARD_DICT_FILE, read on first use along with the undo history in it.
+    Call with wildcard_lock held.
+    """
+    global wildcard_journal
+    journal = wildcard_journal
+    if journal is None or journal.path != WILDCARD_DICT_FILE:
+        if journal is not None:
+            # not flush(), which would wait for a compaction waiting for wildcard_lock
+            journal.close()
+        journal = EditJournal(WILDCARD_DICT_FILE, lambda: snapshot_wildcard_menu(journal), write_wildcard_dict,
+                              WILDCARD_FSYNC_INTERVAL, WILDCARD_JOURNAL_COMPACT_SIZE)
+        wildcard_menu_history.clear()
+        for record in journal.open():
+            if not record.get("undone"):
+                push_menu_history(record["undo"])
+            elif wildcard_menu_history:
+                wildcard_menu_history.pop()
+        wildcard_journal = journal
+    return journal
+
+
+def snapshot_wildcard_menu(journal):
+    """
+    :return: (seq of the last edit in the journal, m.yaml content of wildcard_menu),
+             None if the journal was replaced, since wildcard_menu is not its menu any more
+    """
+    with wildcard_lock:
+        if journal is not wildcard_journal:
+            return None
+        return journal.seq, wildcard_menu.to_nested()
+
+
+def flush_wildcard_dict():
+    """
+    Write pending m.yaml journal edits now. Returns when they are on disk.
+    """
+    journal = wildcard_journal
+    if journal is not None:
+        journal.flush()
+
 
-    dir_path = os.path.dirname(WILDCARD_DICT_FILE)
-    if not os.path.exists(dir_path):
-        os.makedirs(dir_path)
-    with open(WILDCARD_DICT_FILE, "w") as f:
-        yaml.dump(m_wildcard_dict_new, f, encoding="utf-8", allow_unicode=True, sort_keys=False)
+atexit.register(flush_wildcard_dict)
+
+
+def write_wildcard_dict(m_wildcard_dict, f):
+    yaml.dump(m_wildcard_dict, f, encoding="utf-8", allow_unicode=True, sort_keys=False)
 
 # move all slots in from_group to specified position
 def reorder_group(from_group, to_group, position):
-    global wildcard_dict
     with wildcard_lock:
-        # Get all slots in the source group
-        from_slots = [(k, v) for k, v in wildcard_dict.items() if k.startswith("m/" + from_group + "/")]
-        
-        # If no slots found in the source group, return
-        if not from_slots:
-            return
+        group_key = "m/" + from_group
 
-        # Remove all slots from the source group
-        for k, _ in from_slots:
-            del wildcard_dict[k]
+        # If the source group has no slots, return
+        if group_key not in wildcard_menu.groups:
+            return
 
         if position == "end" or to_group is None:
-            # Find the last non-group slot (slots directly under 'm' directory)
-            non_group_slots = [(k, v) for k, v in wildcard_dict.items() if k.startswith('m/') and len(k.split('/')) == 2]
-            if non_group_slots:
-                last_slot = non_group_slots[-1][0]
-                # Add slots after the last non-group slot
-                new_dict = {}
-                for k, v in wildcard_dict.items():
-                    new_dict[k] = v
-                    if k == last_slot:
-                        for from_k, from_v in from_slots:
-                            new_dict[from_k] = from_v
-                wildcard_dict = new_dict
-            else:
-                # If no non-group slots, add at the beginning
-                for from_k, from_v in reversed(from_slots):
-                    wildcard_dict = {from_k: from_v, **wildcard_dict}
+            # Move after the last non-group slot (slots directly in the parent group), or to the front
+            last_slot = wildcard_menu.last_slot_child(parent_key(group_key))
+            wildcard_menu.move(group_key, after=last_slot, is_group=True)
         else:  # position == "before" and to_group is not None
-            # Find all slots in the target group
-            to_slots = [(k, v) for k, v in wildcard_dict.items() if k.startswith("m/" + to_group + "/")]
-            if to_slots:
-                # Add slots before the first slot of the target group
-                first_slot = to_slots[0][0]
-                new_dict = {}
-                for k, v in wildcard_dict.items():
-                    if k == first_slot:
-                        for from_k, from_v in from_slots:
-                            new_dict[from_k] = from_v
-                    new_dict[k] = v
-                wildcard_dict = new_dict
-
-        save_wildcard_dict(wildcard_dict)
+            # Move before the target group
+            to_key = "m/" + to_group
+            if to_key not in wildcard_menu.groups or parent_key(to_key) != parent_key(group_key):
+                return
+            wildcard_menu.move(group_key, before=to_key, is_group=True)
+
+        menu_edited()
 
 def convert_group_to_dict(wildcard_dict):
     group_name = None
@@ -734,29 +1687,175 @@ def remove_lora_tags(string):
     return result
 
 
-def resolve_lora_name(lora_name_cache, name):
-    if os.path.exists(name):
+class LoraNameIndex:
+    """
+    Suffix index of LoRA file names, for tags which give the end of a name.
+
+    The names are kept reversed and sorted, so the names ending with a tag are
+    a range found by bisection. Like the scan it replaces, a tag matches any
+    name ending with it and the first such name in list order wins.
+    """
+
+    def __init__(self, names, folders=None):
+        self.names = names
+        self.folders = folders or {}  # folder -> mtime when the names were listed
+        self.reversed_names = sorted((x[::-1], i) for i, x in enumerate(names))
+
+    def find_all(self, name):
+        """
+        :return: names ending with name, in list order
+        """
+        reversed_name = name[::-1]
+        start = bisect.bisect_left(self.reversed_names, (reversed_name,))
+        matches = []
+        for i in range(start, len(self.reversed_names)):
+            reversed_x, position = self.reversed_names[i]
+            if not reversed_x.startswith(reversed_name):
+                break
+            matches.append(position)
+        return [self.names[i] for i in sorted(matches)]
+
+    def find(self, name):
+        """
+        :return: first name ending with name, None if there is none
+
+        The match is reported as ambiguous when more than one name has name as
+        its whole file name or path suffix, or when the name used does not but
+        another one does.
+        """
+        matches = self.find_all(name)
+        if len(matches) > 1:
+            whole = [x for x in matches if x == name or x[-len(name) - 1] in "/\\"]
+            if len(whole) > 1 or (whole and whole[0] != matches[0]):
+                print(f"[WildDivide] LoRA '{name}' is ambiguous: {', '.join(whole)}. Using '{matches[0]}'.")
+        return matches[0] if matches else None
+
+
+def get_lora_name_index():
+    """
+    The loras folders are listed again only when one of them was added or its
+    mtime changed, the same check folder_paths uses for its own listing cache.
+
+    :return: LoraNameIndex of the contents of the loras folders
+    """
+    global lora_name_index
+    index = lora_name_index
+    if index is not None and index.folders and all(get_folder_mtime(x) == t for x, t in index.folders.items()) \
+            and all(x in index.folders or not os.path.isdir(x) for x in folder_paths.get_folder_paths("loras")):
+        return index
+    folders = {x: get_folder_mtime(x) for x in folder_paths.get_folder_paths("loras")}
+    names = folder_paths.get_filename_list("loras")
+    cached = folder_paths.filename_list_cache.get("loras")
+    if cached is not None:
+        folders = dict(cached[1])
+    if index is None or index.names != names:
+        index = LoraNameIndex(names, folders)
+        lora_name_index = index
+    else:
+        index.folders = folders
+    return index
+
+
+def get_folder_mtime(path):
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return None
+
+
+def resolve_lora_name(name):
+    if os.path.isabs(name) and os.path.exists(name):
         return name
     else:
-        if len(lora_name_cache) == 0:
-            lora_name_cache.extend(folder_paths.get_filename_list("loras"))
+        return get_lora_name_index().find(name)
+
+
+def get_patch_lineage(obj):
+    lineage = patch_lineage.get(obj)
+    if lineage is None:
+        lineage = (next(patch_lineage_ids), ())
+        patch_lineage[obj] = lineage
+        weakref.finalize(obj, forget_lora_patches, lineage[0])
+    return lineage
+
+
+def set_patched_lineage(obj, patched_obj, lora_spec):
+    if patched_obj is not obj:
+        base, loras = get_patch_lineage(obj)
+        patch_lineage[patched_obj] = (base, sort_lora_specs(loras + (lora_spec,)))
 
-        for x in lora_name_cache:
-            if x.endswith(name):
-                return x
 
+def sort_lora_specs(specs):
+    return tuple(sorted(set(specs), key=repr))
+
+
+def forget_lora_patches(base):
+    """
+    Drop the patched models of a model or clip which was freed, so the cache does not keep its weights alive.
+    """
+    with lora_patch_lock:
+        for key in [key for key in lora_patch_cache if base in key]:
+            del lora_patch_cache[key]
+
+
+def encode_prompt(clip, prompt, clip_encoder=None):
+    """
+    Encode a prompt chunk, reusing the encoding of the same chunk with the same clip and LoRAs.
+
+    Clips are told apart by object and the LoRAs applied to them, so a clip
+    which is loaded again or patched differently is encoded again. Custom
+    encoders are assumed to give the same results for all instances of a class.
+
+    :return: conditioning
+    """
+    key = (get_patch_lineage(clip), None if clip_encoder is None else type(clip_encoder), prompt)
+    conditioning = clip_encode_cache.get(key)
+    if conditioning is None:
+        if clip_encoder is None:
+            conditioning = nodes.CLIPTextEncode().encode(clip, prompt)[0]
+        else:
+            conditioning = clip_encoder.encode(clip, prompt)[0]
+        clip_encode_cache.put(key, conditioning)
+    return conditioning
+
+
+def process_pass1(pass1, model, clip, clip_encoder=None, seed=None, processed=None):
+    model, clip, pass2 = apply_loras(pass1, model, clip)
+    pass3 = split_prompt_chunks(pass2)
+
+    result = concat_conditionings([encode_prompt(clip, prompt, clip_encoder) for prompt in pass3])
+
+    if processed is not None:
+        processed.append(pass1)
+        processed.append(pass2)
+        processed.append(pass3)
+
+    return model, clip, result
+
+
+def apply_loras(pass1, model, clip):
+    """
+    Apply the <lora:...> tags of a prompt.
 
-def process_pass1(pass1, lora_name_cache, model, clip, clip_encoder=None, seed=None, processed=None):
-    loras = extract_lora_values(pass1)
+    :return: model, clip, prompt without the tags
+    """
     pass2 = remove_lora_tags(pass1)
+    model, clip = patch_loras(model, clip, resolve_lora_specs(pass1))
+    return model, clip, pass2
+
 
-    for lora_name, model_weight, clip_weight, lbw, lbw_a, lbw_b in loras:
+def resolve_lora_specs(pass1):
+    """
+    :return: (lora file name, model weight, clip weight, lbw, lbw_a, lbw_b) of each <lora:...> tag which was found
+    """
+    specs = []
+    for lora_name, model_weight, clip_weight, lbw, lbw_a, lbw_b in extract_lora_values(pass1):
         lora_name_ext = lora_name.split('.')
         if ('.'+lora_name_ext[-1]) not in folder_paths.supported_pt_extensions:
             lora_name = lora_name+".safetensors"
 
         orig_lora_name = lora_name
-        lora_name = resolve_lora_name(lora_name_cache, lora_name)
+        lora_name = resolve_lora_name(lora_name)
 
         if lora_name is not None:
             path = folder_paths.get_full_path("loras", lora_name)
@@ -764,27 +1863,82 @@ def process_pass1(pass1, lora_name_cache, model, clip, clip_encoder=None, seed=N
             path = None
 
         if path is not None:
-            print(f"LOAD LORA: {lora_name}: {model_weight}, {clip_weight}, LBW={lbw}, A={lbw_a}, B={lbw_b}")
+            specs.append((lora_name, model_weight, clip_weight, lbw, lbw_a, lbw_b))
+        else:
+            print(f"LORA NOT FOUND: {orig_lora_name}")
+    return specs
 
-            def default_lora():
-                return nodes.LoraLoader().load_lora(model, clip, lora_name, model_weight, clip_weight)
 
-            if lbw is not None:
-                if 'LoraLoaderBlockWeight //Inspire' not in nodes.NODE_CLASS_MAPPINGS:
-                    # utils.try_install_custom_node(
-                    #     'https://github.com/ltdrdata/ComfyUI-Inspire-Pack',
-                    #     "To use 'LBW=' syntax in wildcards, 'Inspire Pack' extension is required.")
+def patch_loras(model, clip, specs):
+    """
+    Apply LoRAs which are not applied to the model and clip yet.
 
-                    print(f"'LBW(Lora Block Weight)' is given, but the 'Inspire Pack' is not installed. The LBW= attribute is being ignored.")
-                    model, clip = default_lora()
-                else:
-                    cls = nodes.NODE_CLASS_MAPPINGS['LoraLoaderBlockWeight //Inspire']
-                    model, clip, _ = cls().doit(model, clip, lora_name, model_weight, clip_weight, False, 0, lbw_a, lbw_b, "", lbw)
-            else:
-                model, clip = default_lora()
+    A LoRA which is already applied, by an earlier tag or [SEP] region, is not
+    applied again. The patched pairs of the last prompt are kept per source
+    model and clip until they are freed, so a run with the same LoRAs reuses
+    them without patching. Patching from a pair which is not in that chain
+    drops the rest of it, since each pair holds its own patched weights.
+
+    :param specs: resolve_lora_specs() result
+    :return: model, clip
+    """
+    model_base, model_loras = get_patch_lineage(model)
+    clip_base, clip_loras = get_patch_lineage(clip)
+    applied = set(model_loras) & set(clip_loras)
+    new_specs = [spec for spec in dict.fromkeys(specs) if spec not in applied]
+    if not new_specs:
+        return model, clip
+
+    target = sort_lora_specs(applied | set(new_specs))
+    key = (model_base, clip_base)
+    source = (model_loras, clip_loras)
+    with lora_patch_lock:
+        cached = lora_patch_cache.get(key, {}).get(source)
+    if cached is not None and cached[0] == target:
+        print(f"LORA: reusing patched model for {', '.join(spec[0] for spec in target)}")
+        return cached[1], cached[2]
+
+    for spec in new_specs:
+        patched_model, patched_clip = apply_lora(model, clip, spec)
+        set_patched_lineage(model, patched_model, spec)
+        set_patched_lineage(clip, patched_clip, spec)
+        model, clip = patched_model, patched_clip
+
+    if get_patch_lineage(model) == (model_base, target) and get_patch_lineage(clip) == (clip_base, target):
+        with lora_patch_lock:
+            chain = {loras: patched for loras, patched in lora_patch_cache.get(key, {}).items()
+                     if loras != source and set(loras[0]) <= set(model_loras) and set(loras[1]) <= set(clip_loras)}
+            chain[source] = (target, model, clip)
+            lora_patch_cache[key] = chain
+    return model, clip
+
+
+def apply_lora(model, clip, spec):
+    lora_name, model_weight, clip_weight, lbw, lbw_a, lbw_b = spec
+    print(f"LOAD LORA: {lora_name}: {model_weight}, {clip_weight}, LBW={lbw}, A={lbw_a}, B={lbw_b}")
+
+    def default_lora():
+        return nodes.LoraLoader().load_lora(model, clip, lora_name, model_weight, clip_weight)
+
+    if lbw is not None:
+        if 'LoraLoaderBlockWeight //Inspire' not in nodes.NODE_CLASS_MAPPINGS:
+            # utils.try_install_custom_node(
+            #     'https://github.com/ltdrdata/ComfyUI-Inspire-Pack',
+            #     "To use 'LBW=' syntax in wildcards, 'Inspire Pack' extension is required.")
+
+            print(f"'LBW(Lora Block Weight)' is given, but the 'Inspire Pack' is not installed. The LBW= attribute is being ignored.")
+            return default_lora()
         else:
-            print(f"LORA NOT FOUND: {orig_lora_name}")
+            cls = nodes.NODE_CLASS_MAPPINGS['LoraLoaderBlockWeight //Inspire']
+            model, clip, _ = cls().doit(model, clip, lora_name, model_weight, clip_weight, False, 0, lbw_a, lbw_b, "", lbw)
+            return model, clip
+    return default_lora()
+
 
+def split_prompt_chunks(pass2):
+    """
+    :return: non-empty BREAK chunks of a prompt, [''] if there are none
+    """
     pass3 = [x.strip() for x in pass2.split("BREAK")]
     pass3 = [x for x in pass3 if x != '']
 
@@ -793,43 +1947,130 @@ def process_pass1(pass1, lora_name_cache, model, clip, clip_encoder=None, seed=N
 
     pass3_str = [f'[{x}]' for x in pass3]
     print(f"CLIP: {str.join(' + ', pass3_str)}")
+    return pass3
 
-    result = None
-
-    for prompt in pass3:
-        if clip_encoder is None:
-            cur = nodes.CLIPTextEncode().encode(clip, prompt)[0]
-        else:
-            cur = clip_encoder.encode(clip, prompt)[0]
 
+def concat_conditionings(conditionings):
+    result = None
+    for cur in conditionings:
         if result is not None:
             result = nodes.ConditioningConcat().concat(result, cur)[0]
         else:
             result = cur
+    return result
 
-    if processed is not None:
-        processed.append(pass1)
-        processed.append(pass2)
-        processed.append(pass3)
 
-    return model, clip, result
+def encode_prompts_batched(requests):
+    """
+    Encode prompt chunks with as few CLIP passes as possible.
+
+    Chunks which are not cached are grouped by clip. The tokens of a group are
+    encoded in one pass when every chunk has sections of the same length, which
+    is the case for the 77 token windows of CLIP; the output is split back by
+    section. A pass only yields the pooled output of its first section, which
+    is the pooled output of its first chunk, so the pooled outputs of the other
+    chunks that are needed are encoded from their first section on their own.
+    Groups which cannot be batched are encoded chunk by chunk. Encodings
+    without their pooled output are cached under a key of their own.
+
+    :param requests: (clip, prompt, needs_pooled) tuples
+    :return: conditioning for each request
+    """
+    results = [None] * len(requests)
+    groups = {}
+    for i, (clip, prompt, needs_pooled) in enumerate(requests):
+        key = (get_patch_lineage(clip), None, prompt)
+        results[i] = clip_encode_cache.get(key)
+        if results[i] is None and not needs_pooled:
+            results[i] = clip_encode_cache.get(key + ("without pooled",))
+        if results[i] is None:
+            group = groups.setdefault(id(clip), (clip, {}))
+            group[1].setdefault(prompt, []).append(i)
+
+    for clip, prompts in groups.values():
+        encoded = encode_prompt_group(clip, list(prompts.keys()),
+                                      [any(requests[i][2] for i in indices) for indices in prompts.values()])
+        for (prompt, indices), (conditioning, complete) in zip(prompts.items(), encoded):
+            key = (get_patch_lineage(clip), None, prompt)
+            clip_encode_cache.put(key if complete else key + ("without pooled",), conditioning)
+            for i in indices:
+                results[i] = conditioning
+    return results
+
+
+def encode_prompt_group(clip, prompts, needs_pooled):
+    """
+    :return: (conditioning, whether its pooled output was encoded) for each prompt
+    """
+    tokens = [clip.tokenize(prompt) for prompt in prompts]
+    sections = batchable_sections(tokens)
+    if len(prompts) < 2 or sections is None:
+        return [(nodes.CLIPTextEncode().encode(clip, prompt)[0], True) for prompt in prompts]
+
+    batch = {k: [section for chunk_tokens in tokens for section in chunk_tokens[k]] for k in tokens[0]}
+    cond, pooled = clip.encode_from_tokens(batch, return_pooled=True)
+    section_length = cond.shape[-2] // sum(sections)
+    conds = cond.split([n * section_length for n in sections], dim=-2)
+
+    results = []
+    for i, (chunk_tokens, chunk_cond) in enumerate(zip(tokens, conds)):
+        chunk_pooled = pooled if i == 0 else None
+        complete = i == 0 or pooled is None
+        if not complete and needs_pooled[i]:
+            first_section = {k: v[:1] for k, v in chunk_tokens.items()}
+            chunk_pooled = clip.encode_from_tokens(first_section, return_pooled=True)[1]
+            complete = True
+        results.append(([[chunk_cond, {"pooled_output": chunk_pooled}]], complete))
+    return results
+
+
+def batchable_sections(tokens):
+    """
+    :param tokens: clip.tokenize() result of each chunk, {encoder: [section tokens]}
+    :return: number of sections of each chunk, None if the chunks cannot share a pass
+    """
+    keys = set(tokens[0].keys())
+    lengths = set()
+    sections = []
+    for chunk_tokens in tokens:
+        if set(chunk_tokens.keys()) != keys:
+            return None
+        counts = {len(v) for v in chunk_tokens.values()}
+        if len(counts) != 1:
+            return None
+        sections.append(counts.pop())
+        lengths.update(len(section) for v in chunk_tokens.values() for section in v)
+    if len(lengths) != 1:
+        return None
+    return sections
+
 
 def extract_options(text):
     """
     Extracts all options starting with 'opt:' from the text and removes them.
+    WxH, gridCxR, splitA:B:... and rect:X:Y:W:H carry values, other options are flags.
     
     :param text: Text to process
     :return: (Modified text, Options dictionary)
     """
     options = {}
-    pattern = r'opt:(\w+)'
+    pattern = r'opt:(\w+(?::\d+)*)'
     
     def replace_option(match):
         option = match.group(1)
         size_match = re.match(r'(\d+)x(\d+)', option)
+        grid_match = re.fullmatch(r'grid(\d+)x(\d+)', option)
+        split_match = re.fullmatch(r'split(\d+(?::\d+)+)', option)
+        rect_match = re.fullmatch(r'rect:(\d+):(\d+):(\d+):(\d+)', option)
         if size_match:
             options['width'] = int(size_match.group(1))
             options['height'] = int(size_match.group(2))
+        elif grid_match:
+            options['grid'] = (int(grid_match.group(1)), int(grid_match.group(2)))
+        elif split_match:
+            options['split'] = tuple(int(x) for x in split_match.group(1).split(':'))
+        elif rect_match:
+            options.setdefault('rects', []).append(tuple(int(x) for x in rect_match.groups()))
         else:
             options[option] = True
         return ''
@@ -851,15 +2092,28 @@ def process_with_loras(wildcard_opt, model, clip, clip_encoder=None, seed=None,
     :return: model, clip, conditioning, options
     """
 
-    lora_name_cache = []
-
     pass1_result, last_generated = process(wildcard_opt, seed)
     pass1_result, options = extract_options(pass1_result)
     pass1_parts = pass1_result.split("[SEP]")
     result = []
 
+    if BATCH_CLIP_ENCODE and clip_encoder is None:
+        parts = []
+        for part in pass1_parts:
+            model, clip, pass2 = apply_loras(part, model, clip)
+            pass3 = split_prompt_chunks(pass2)
+            parts.append((clip, pass3))
+            if processed is not None:
+                processed.extend([part, pass2, pass3])
+
+        requests = [(part_clip, prompt, i == 0) for part_clip, pass3 in parts for i, prompt in enumerate(pass3)]
+        conditionings = iter(encode_prompts_batched(requests))
+        for _, pass3 in parts:
+            result.append(concat_conditionings([next(conditionings) for _ in pass3]))
+        return model, clip, result, options
+
     for part in pass1_parts:
-        model, clip, part_result = process_pass1(part, lora_name_cache, model, clip, clip_encoder, seed, processed)
+        model, clip, part_result = process_pass1(part, model, clip, clip_encoder, seed, processed)
         result.append(part_result)
 
     return model, clip, result, options
@@ -880,16 +2134,17 @@ def split_to_dict(text):
 
 
 class WildcardChooser:
-    def __init__(self, items, randomize_when_exhaust):
+    def __init__(self, items, randomize_when_exhaust, rng=random):
         self.i = 0
         self.items = items
         self.randomize_when_exhaust = randomize_when_exhaust
+        self.rng = rng
 
     def get(self, seg):
         if self.i >= len(self.items):
             self.i = 0
             if self.randomize_when_exhaust:
-                random.shuffle(self.items)
+                self.rng.shuffle(self.items)
 
         item = self.items[self.i]
         self.i += 1
@@ -912,7 +2167,7 @@ class WildcardChooserDict:
         return text
 
 
-def split_string_with_sep(input_string):
+def split_string_with_sep(input_string, rng=random):
     sep_pattern = r'\[SEP(?:\:\w+)?\]'
 
     substrings = re.split(sep_pattern, input_string)
@@ -925,7 +2180,7 @@ def split_string_with_sep(input_string):
             if matches[i] == '[SEP]':
                 result_list.append(None)
             elif matches[i] == '[SEP:R]':
-                result_list.append(random.randint(0, 1125899906842624))
+                result_list.append(rng.randint(0, 1125899906842624))
             else:
                 try:
                     seed = int(matches[i][5:-1])
@@ -937,7 +2192,7 @@ def split_string_with_sep(input_string):
     return list(zip(iterable, iterable))
 
 
-def process_wildcard_for_segs(wildcard):
+def process_wildcard_for_segs(wildcard, rng=random):
     if wildcard.startswith('[LAB]'):
         raw_items = split_to_dict(wildcard)
 
@@ -954,28 +2209,124 @@ def process_wildcard_for_segs(wildcard):
 
         if match:
             mode = match[1]
-            items = split_string_with_sep(wildcard[len(match[0]):])
+            items = split_string_with_sep(wildcard[len(match[0]):], rng)
 
             if mode == 'RND':
-                random.shuffle(items)
-                return mode, WildcardChooser(items, True)
+                rng.shuffle(items)
+                return mode, WildcardChooser(items, True, rng)
             else:
-                return mode, WildcardChooser(items, False)
+                return mode, WildcardChooser(items, False, rng)
 
         else:
             return None, WildcardChooser([(None, wildcard)], False)
 
 
 def wildcard_load():
-    global wildcard_dict
-    wildcard_dict = {}
+    """
+    Read all wildcard files again.
+    """
+    wildcard_reload(full=True)
 
-    with wildcard_lock:
-        read_wildcard_dict(wildcards_path)
 
+def wildcard_reload(full=False):
+    """
+    Read the wildcard files which changed since the last load and swap in a
+    new wildcard dict. Expansions which already started keep using the dict
+    they started with.
+
+    Values of unchanged files are taken from the current dict, so keys which
+    were already loaded stay loaded. The m/ slots are those of m.yaml with the
+    edits of its journal replayed, unless m.yaml was changed by hand since.
+
+    :param full: read every file, not only the changed ones
+    :return: True if the wildcard dict was replaced
+    """
+    global wildcard_files, wildcard_key_files, wildcard_cache
+    with wildcard_reload_lock:
+        with wildcard_lock:
+            journal = get_wildcard_journal()
+        # m.yaml is not compacted while it is read, so it matches the journal records
+        with journal.compaction_lock:
+            current = get_wildcard_dict()
+            if full or wildcard_cache is None or (wildcard_cache is False) != EAGER_WILDCARD_LOAD:
+                previous = {}
+                wildcard_cache = False
+                if not EAGER_WILDCARD_LOAD:
+                    wildcard_cache = WildcardCache(WILDCARD_CACHE_FILE)
+                    wildcard_cache.load()
+            else:
+                previous = wildcard_files
+            cache = wildcard_cache or None
+            wildcard_file_timings.clear()
+
+            files = {}
+            # files which cannot be read keep their last records, see read_wildcard_dict(),
+            # and a directory which cannot be walked keeps all of them
+            try:
+                files[wildcards_path] = read_wildcard_dict(wildcards_path, cache, previous.get(wildcards_path),
+                                                           wildcard_files.get(wildcards_path))
+            except Exception as e:
+                print(f"[WildDivide] Failed to load wildcards directory. {e}")
+                files[wildcards_path] = wildcard_files.get(wildcards_path, {})
+            try:
+                files[default_wildcards_path] = read_wildcard_dict(default_wildcards_path, cache,
+                                                                   previous.get(default_wildcards_path),
+                                                                   wildcard_files.get(default_wildcards_path))
+            except Exception as e:
+                print(f"[WildDivide] Failed to load custom wildcards directory. {e}")
+                files[default_wildcards_path] = wildcard_files.get(default_wildcards_path, {})
+
+            # m.yaml changed by hand is taken as it is, the journal edits made before are dropped
+            if not journal.check_snapshot():
+                with wildcard_lock:
+                    wildcard_menu_history.clear()
+
+            if not full and files == previous:
+                return False
+
+            new_dict = LazyWildcardDict()
+            key_files = {}
+            for path, records in files.items():
+                for file_path, record in records.items():
+                    reused = previous.get(path, {}).get(file_path) is record
+                    for k, v in record[1]:
+                        if reused and wildcard_key_files.get(k) == file_path and k in current:
+                            v = dict.get(current, k)
+                        dict.__setitem__(new_dict, k, v)
+                        key_files[k] = file_path
+            # the menu is edited and journaled with its values, so they are loaded now
+            menu_items = [(k, new_dict[k]) for k in list(new_dict.keys()) if k.startswith("m/")]
+
+            with wildcard_lock:
+                # edits since the last compaction, including those made while reading
+                menu = MenuTree.from_items(menu_items)
+                skipped = apply_menu_ops(menu, [op for record in journal.records for op in record["ops"]])
+                menu.take_ops()
+                if skipped:
+                    print(f"[WildDivide] Skipped {skipped} changes of the m.yaml journal which do not apply any more.")
+                publish_wildcard_dict(with_menu(new_dict, menu), menu)
+                wildcard_files = files
+                wildcard_key_files = key_files
+                rebuild_wildcard_index()
+
+    if cache is not None:
         try:
-            read_wildcard_dict(default_wildcards_path)
+            cache.save([file_path for records in files.values() for file_path in records if file_path.endswith('.yaml')])
         except Exception as e:
-            print(f"[WildDivide] Failed to load custom wildcards directory. {e}")
+            print(f"[WildDivide] Failed to save wildcard cache. {e}")
+    report_wildcard_file_timings()
+    print(f"[WildDivide] Wildcards loading done.")
+    return True
+
 
-        print(f"[WildDivide] Wildcards loading done.")
+def wildcard_watch():
+    """
+    Load the wildcards, then reload changed files every WILDCARD_POLL_INTERVAL seconds.
+    """
+    wildcard_load()
+    while WILDCARD_POLL_INTERVAL:
+        time.sleep(WILDCARD_POLL_INTERVAL)
+        try:
+            wildcard_reload()
+        except Exception as e:
+            print(f"[WildDivide] Failed to reload wildcards. {e}")